@@ -0,0 +1,289 @@
+from typing import Iterable, Iterator, Optional
+import io
+import os
+import itertools
+import tarfile
+import random
+import multiprocessing
+import numpy as np
+import cv2
+import imgaug as ia
+from dataclasses import dataclass
+from .decks.base import Deck
+from .scenes.base import Scene
+from .scenes.fanned import FannedSceneGenerator
+from .scenes.image_source import BackgroundImageSource, CardImageSource
+from .util import atomic_write
+from . import metrics
+
+VOC_ANNOTATION_TEMPLATE = """<annotation>
+    <folder>{folder}</folder>
+    <filename>{filename}</filename>
+    <path>{path}</path>
+    <source>
+        <database>Unknown</database>
+    </source>
+    <size>
+        <width>{width}</width>
+        <height>{height}</height>
+        <depth>3</depth>
+    </size>
+{objects}</annotation>
+"""
+
+VOC_OBJECT_TEMPLATE = """    <object>
+        <name>{name}</name>
+        <pose>Unspecified</pose>
+        <truncated>0</truncated>
+        <difficult>0</difficult>
+        <bndbox>
+            <xmin>{x1}</xmin>
+            <ymin>{y1}</ymin>
+            <xmax>{x2}</xmax>
+            <ymax>{y2}</ymax>
+        </bndbox>
+    </object>
+"""
+
+# darknet-style list of class names, one per line; a YOLO label's class id is its line number
+CLASS_NAMES_FILENAME = "classes.names"
+# for sharded output: the tar and offset of every file within the shards, written last
+SHARD_INDEX_FILENAME = "index.npz"
+
+
+@dataclass
+class DatasetParameters:
+    deck: Deck
+    backgrounds_dir: str
+    cards_dir: str
+    outdir: str
+    width: int = 1000
+    height: int = 1000
+    cards_per_scene: int = 3
+    seed: int = 0
+    yolo_labels: bool = True
+    voc_labels: bool = False
+    # pack this many scenes into each tar shard, or 0 to write loose files
+    shard_size: int = 0
+    # without a card atlas, decode card images on first use into a cache of at most this
+    # many bytes per worker, or 0 to decode them all up front
+    card_cache_bytes: int = 0
+
+
+# populated once per worker process by _init_worker, so that the (large) image sources
+# are loaded once per process instead of once per scene
+_worker_parameters: Optional[DatasetParameters] = None
+_worker_generator: Optional[FannedSceneGenerator] = None
+_worker_class_ids: dict[str, int] = {}
+# a pool replaces any worker whose initializer raises, forever, so _init_worker keeps its
+# error here instead and every task raises it, which fails the whole run
+_worker_init_error: Optional[Exception] = None
+
+
+def seed_for_scene(seed: int, index: int) -> int:
+    # derive an independent stream per scene rather than per worker, so that the output
+    # for a given seed does not depend on how scenes happen to be scheduled across workers
+    return int(np.random.SeedSequence((seed, index)).generate_state(1)[0])
+
+
+def get_class_names(deck: Deck) -> list[str]:
+    return sorted(name for group in deck.cards for name in group.card_names)
+
+
+def format_voc_annotation(image_path: str, scene: Scene) -> str:
+    image, bounding_boxes = scene
+    height, width = image.shape[:2]
+    objects = "".join(
+        VOC_OBJECT_TEMPLATE.format(
+            name=b.label, x1=int(b.x1), y1=int(b.y1), x2=int(b.x2), y2=int(b.y2)
+        )
+        for b in bounding_boxes
+    )
+    return VOC_ANNOTATION_TEMPLATE.format(
+        folder=os.path.basename(os.path.dirname(image_path)),
+        filename=os.path.basename(image_path),
+        path=image_path,
+        width=width,
+        height=height,
+        objects=objects,
+    )
+
+
+def write_voc_annotation(path: str, image_path: str, scene: Scene):
+    with open(path, "w") as f:
+        f.write(format_voc_annotation(image_path, scene))
+
+
+def format_yolo_labels(scene: Scene, class_ids: dict[str, int]) -> str:
+    """
+    One "class x_center y_center width height" line per box, relative to the image size.
+    """
+    image, bounding_boxes = scene
+    height, width = image.shape[:2]
+    return "".join(
+        f"{class_ids[b.label]} {b.center_x / width:0.6f} {b.center_y / height:0.6f} "
+        f"{b.width / width:0.6f} {b.height / height:0.6f}\n"
+        for b in bounding_boxes
+    )
+
+
+def _init_worker(parameters: DatasetParameters):
+    global _worker_parameters, _worker_generator, _worker_class_ids, _worker_init_error
+    _worker_parameters = parameters
+    try:
+        cards = CardImageSource.from_disk(
+            parameters.cards_dir, cache_bytes=parameters.card_cache_bytes
+        )
+        if len(cards) == 0:
+            raise ValueError(
+                f"no card images with hulls in {parameters.cards_dir}; "
+                "run find-convex-hulls first"
+            )
+        _worker_generator = FannedSceneGenerator(
+            width=parameters.width,
+            height=parameters.height,
+            deck=parameters.deck,
+            backgrounds=BackgroundImageSource.from_disk(
+                parameters.backgrounds_dir,
+                min_size=max(parameters.width, parameters.height),
+            ),
+            cards=cards,
+        )
+    except Exception as e:
+        _worker_init_error = e
+        return
+    _worker_class_ids = {
+        name: i for i, name in enumerate(get_class_names(parameters.deck))
+    }
+
+
+def _render_scene(index: int) -> tuple[list[tuple[str, bytes]], int]:
+    """
+    Returns the encoded image and labels for a scene as (filename, contents) pairs, along
+    with the number of bounding boxes in it.
+    """
+    if _worker_init_error is not None:
+        raise _worker_init_error
+    assert _worker_parameters is not None and _worker_generator is not None
+
+    # the generators draw from both the stdlib and the imgaug global RNGs
+    scene_seed = seed_for_scene(_worker_parameters.seed, index)
+    random.seed(scene_seed)
+    ia.seed(scene_seed)
+
+    scene = _worker_generator.generate_scene(_worker_parameters.cards_per_scene)
+    image, bounding_boxes = scene
+
+    name = f"{index:06d}"
+    # image sources are decoded by OpenCV, so scenes are already BGR
+    _, jpg = cv2.imencode(".jpg", image)
+    files = [(f"{name}.jpg", jpg.tobytes())]
+    if _worker_parameters.yolo_labels:
+        files.append(
+            (f"{name}.txt", format_yolo_labels(scene, _worker_class_ids).encode())
+        )
+    if _worker_parameters.voc_labels:
+        image_path = os.path.join(_worker_parameters.outdir, f"{name}.jpg")
+        files.append((f"{name}.xml", format_voc_annotation(image_path, scene).encode()))
+
+    return files, len(bounding_boxes)
+
+
+def _generate_scene(index: int) -> int:
+    assert _worker_parameters is not None
+
+    files, n_boxes = _render_scene(index)
+    for filename, contents in files:
+        with open(os.path.join(_worker_parameters.outdir, filename), "wb") as f:
+            f.write(contents)
+    return n_boxes
+
+
+def _write_shard(
+    outdir: str,
+    shard: int,
+    rendered: Iterable[tuple[list[tuple[str, bytes]], int]],
+    members: list[tuple[str, int, int, int]],
+) -> Iterator[int]:
+    """
+    Pack rendered scenes into one tar, yielding the number of bounding boxes in each as
+    it's written. Appends the (filename, shard, offset, size) of every file to members.
+    """
+    with atomic_write(os.path.join(outdir, f"{shard:05d}.tar")) as f, tarfile.open(
+        fileobj=f, mode="w"
+    ) as tar:
+        for files, n_boxes in rendered:
+            for filename, contents in files:
+                info = tarfile.TarInfo(filename)
+                info.size = len(contents)
+                tar.addfile(info, io.BytesIO(contents))
+                # the data is padded out to whole blocks after its header
+                padded_size = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                members.append((filename, shard, tar.offset - padded_size, info.size))
+            yield n_boxes
+
+
+def _write_shard_index(outdir: str, members: list[tuple[str, int, int, int]]):
+    members.sort()
+    with atomic_write(os.path.join(outdir, SHARD_INDEX_FILENAME)) as f:
+        np.savez(
+            f,
+            filenames=np.array([m[0] for m in members], dtype=str),
+            shards=np.array([m[1] for m in members], dtype=np.int32),
+            offsets=np.array([m[2] for m in members], dtype=np.int64),
+            sizes=np.array([m[3] for m in members], dtype=np.int64),
+        )
+
+
+def generate_dataset(
+    parameters: DatasetParameters, n_scenes: int, *, jobs: int, chunk_size: int = 16
+) -> Iterator[int]:
+    """
+    Render and write n_scenes scenes across a pool of jobs processes. Yields the number of
+    bounding boxes written for each scene as it completes, in no particular order.
+
+    With a shard_size, scenes are packed into numbered tars instead of loose files, and
+    an index of where every file lies within them is written once they are all done.
+    """
+    # check what can be checked before starting any workers; see _worker_init_error
+    min_width, min_height = parameters.deck.width * 2, parameters.deck.height * 2
+    if parameters.width <= min_width or parameters.height <= min_height:
+        raise ValueError(
+            f"scenes must be larger than {min_width}x{min_height} to fit a hand of "
+            f"{parameters.deck.width}x{parameters.deck.height} cards"
+        )
+
+    # bring the background caches up to date up front, otherwise every worker would race
+    # to write them; they're memory-mapped, so this is cheap when they're already current
+    BackgroundImageSource.from_disk(
+        parameters.backgrounds_dir, min_size=max(parameters.width, parameters.height)
+    )
+
+    os.makedirs(parameters.outdir, exist_ok=True)
+
+    with open(os.path.join(parameters.outdir, CLASS_NAMES_FILENAME), "w") as f:
+        f.writelines(f"{name}\n" for name in get_class_names(parameters.deck))
+
+    with multiprocessing.Pool(
+        jobs, initializer=_init_worker, initargs=(parameters,)
+    ) as pool:
+        if not parameters.shard_size:
+            yield from metrics.imap(pool, _generate_scene, range(n_scenes), chunk_size)
+            return
+
+        # scenes are rendered across the whole pool as usual, but come back in order so
+        # that they can be streamed into one shard after another
+        rendered = metrics.imap(
+            pool, _render_scene, range(n_scenes), chunk_size, ordered=True
+        )
+        members: list[tuple[str, int, int, int]] = []
+        for shard, first in enumerate(range(0, n_scenes, parameters.shard_size)):
+            yield from _write_shard(
+                parameters.outdir,
+                shard,
+                itertools.islice(
+                    rendered, min(parameters.shard_size, n_scenes - first)
+                ),
+                members,
+            )
+        _write_shard_index(parameters.outdir, members)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Counter, Iterator, Optional
 import numpy as np
 import cv2
 import itertools
@@ -6,8 +6,26 @@ from dataclasses import dataclass
 from cached_property import cached_property
 from tqdm import tqdm
 from .types import Image, ConvexHull
+from . import metrics
 
 ALPHA_BORDER_SIZE = 2
+SEARCH_RECT_EDGE_MARGIN = 2
+PREFILTER_CLOSE_KERNEL = np.ones((3, 3), dtype=np.uint8)
+
+# x1, y1, x2, y2
+SearchRect = tuple[int, int, int, int]
+
+# the stages of the extraction cascade that can reject a frame, cheapest first
+REJECTED_BY_PREFILTER_FOCUS = "prefilter_focus"
+REJECTED_BY_PREFILTER_SHAPE = "prefilter_shape"
+REJECTED_BY_FOCUS = "focus"
+REJECTED_BY_SHAPE = "shape"
+REJECTION_STAGES = (
+    REJECTED_BY_PREFILTER_FOCUS,
+    REJECTED_BY_PREFILTER_SHAPE,
+    REJECTED_BY_FOCUS,
+    REJECTED_BY_SHAPE,
+)
 
 
 @dataclass
@@ -15,6 +33,18 @@ class ImageExtractionParameters:
     card_width: int
     card_height: int
     min_focus: int = 120
+    # cheap pre-checks run on a grayscale copy of the frame downscaled to this width, and
+    # only frames that pass them go through the full-resolution pipeline
+    prefilter: bool = True
+    prefilter_width: int = 480
+    # these are deliberately far more lenient than the full-resolution checks, since
+    # they're only meant to throw out frames that would certainly be rejected later anyway
+    min_prefilter_focus: int = 60
+    min_prefilter_rectangularity: float = 0.6
+    # fraction of the frame some outline must cover to plausibly be the card; the
+    # full-resolution checks have no minimum size, so this only rules out specks
+    min_prefilter_area_fraction: float = 0.0005
+    min_rectangularity: float = 0.95
 
     @cached_property
     def alpha_mask(self) -> Image:
@@ -86,88 +116,213 @@ def score_focus(image: Image) -> float:
     return cv2.Laplacian(image, cv2.CV_64F).var()
 
 
+def _largest_contour(
+    edged: Image, offset: tuple[int, int] = (0, 0)
+) -> Optional[np.ndarray]:
+    contours, _ = cv2.findContours(
+        edged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset
+    )
+    # assume largest contour (by enclosed area) is the card
+    return max(contours, key=cv2.contourArea) if contours else None
+
+
+def _rectangularity(contour: np.ndarray, box_corners: np.ndarray) -> float:
+    # how close the contour is in size to its own bounding box
+    box_area = cv2.contourArea(box_corners)
+    return cv2.contourArea(contour) / box_area if box_area > 0 else 0
+
+
 @dataclass
 class ExtractCardDebugOutput:
+    prefilter_focus: Optional[float] = None
     focus: Optional[int] = None
     grayscale: Optional[Image] = None
     edged: Optional[Image] = None
     card_contour: Optional[Image] = None
     alpha_channel: Optional[Image] = None
     extracted_card: Optional[Image] = None
+    # one of REJECTION_STAGES, if the image was rejected
+    rejected_by: Optional[str] = None
+    # cv2.minAreaRect of the card, in the coordinate space of the whole image
+    card_rect: Optional[tuple] = None
+
+
+def _prefilter(
+    image: Image,
+    parameters: ImageExtractionParameters,
+    debug_output: ExtractCardDebugOutput,
+) -> Optional[str]:
+    """
+    Cheap checks on a small grayscale copy of the image. Returns the stage that rejected
+    it, if any.
+    """
+    height, width = image.shape[:2]
+    scale = min(1, parameters.prefilter_width / width)
+    small = cv2.cvtColor(
+        cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA),
+        cv2.COLOR_BGR2GRAY,
+    )
+
+    focus = score_focus(small)
+    debug_output.prefilter_focus = focus
+    if focus < parameters.min_prefilter_focus:
+        return REJECTED_BY_PREFILTER_FOCUS
+
+    # a plain blur is plenty at this size; the bilateral filter is what's expensive
+    edged = cv2.Canny(cv2.GaussianBlur(small, (5, 5), 0), 30, 200)
+    # the card's outline comes out thin and broken at this size, so close small gaps in
+    # it, and judge every outline by its convex hull, which the gaps that remain don't
+    # shrink. Edges running into the card's outline from outside would stretch the hull,
+    # so inner outlines are judged too. The card is only known not to be there if none
+    # of them could be it.
+    edged = cv2.morphologyEx(edged, cv2.MORPH_CLOSE, PREFILTER_CLOSE_KERNEL)
+    contours, _ = cv2.findContours(edged, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    min_area = parameters.min_prefilter_area_fraction * small.shape[0] * small.shape[1]
+    for contour in contours:
+        hull = cv2.convexHull(contour)
+        if (
+            cv2.contourArea(hull) >= min_area
+            and _rectangularity(hull, cv2.boxPoints(cv2.minAreaRect(hull)))
+            >= parameters.min_prefilter_rectangularity
+        ):
+            return None
+
+    return REJECTED_BY_PREFILTER_SHAPE
 
 
 def extract_card_from_image(
-    image: Image, parameters: ImageExtractionParameters
+    image: Image,
+    parameters: ImageExtractionParameters,
+    *,
+    search_rect: Optional[SearchRect] = None,
+    debug: bool = False,
 ) -> tuple[Optional[Image], ExtractCardDebugOutput]:
+    """
+    If search_rect is given, only that region of the image is considered at all (including
+    for focus). The card must lie entirely inside it unless it runs off the image itself.
+
+    The intermediate images in the debug output are only kept (or drawn, in the case of the
+    card contour) with debug=True; the scores, rejection stage and card rect always are.
+    """
     debug_output = ExtractCardDebugOutput()
 
-    focus = score_focus(image)
+    full_image = image
+    full_height, full_width = image.shape[:2]
+    x1, y1, x2, y2 = search_rect or (0, 0, full_width, full_height)
+    image = image[y1:y2, x1:x2]
+
+    if parameters.prefilter:
+        with metrics.timer("extract.prefilter"):
+            debug_output.rejected_by = _prefilter(image, parameters, debug_output)
+        if debug_output.rejected_by is not None:
+            return None, debug_output
+
+    with metrics.timer("extract.focus"):
+        focus = score_focus(image)
     debug_output.focus = focus
     if focus < parameters.min_focus:
+        debug_output.rejected_by = REJECTED_BY_FOCUS
         return None, debug_output
 
-    grayscale = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    # reduce noise, but preserve edges
-    grayscale = cv2.bilateralFilter(grayscale, 11, 17, 17)
-    debug_output.grayscale = grayscale
-
-    edged = cv2.Canny(grayscale, 30, 200)
-    debug_output.edged = edged
+    with metrics.timer("extract.bilateral"):
+        grayscale = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # reduce noise, but preserve edges
+        grayscale = cv2.bilateralFilter(grayscale, 11, 17, 17)
+    with metrics.timer("extract.canny"):
+        edged = cv2.Canny(grayscale, 30, 200)
+    if debug:
+        debug_output.grayscale = grayscale
+        debug_output.edged = edged
 
     # TODO: should the input be copied here? does this mutate inputs?
-    contours, _ = cv2.findContours(edged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # assume largest contour (by enclosed area) is the card
-    card_contour = max(contours, key=cv2.contourArea)
+    # from here on, everything is in the coordinates of the whole image, so that the
+    # card comes out exactly the same whatever region it was found in
+    with metrics.timer("extract.contours"):
+        card_contour = _largest_contour(edged, offset=(x1, y1))
+    if card_contour is None:
+        debug_output.rejected_by = REJECTED_BY_SHAPE
+        return None, debug_output
 
     min_area_bounding_rect = cv2.minAreaRect(card_contour)
     min_area_bounding_rect_corners = np.int0(cv2.boxPoints(min_area_bounding_rect))
 
-    debug_card_contour_image = cv2.cvtColor(edged, cv2.COLOR_GRAY2BGR)
-    cv2.drawContours(
-        debug_card_contour_image, [min_area_bounding_rect_corners], 0, (0, 0, 255), 3
-    )
-    cv2.drawContours(debug_card_contour_image, [card_contour], 0, (0, 255, 0), -1)
-    debug_output.card_contour = debug_card_contour_image
+    if debug:
+        debug_card_contour_image = cv2.cvtColor(edged, cv2.COLOR_GRAY2BGR)
+        cv2.drawContours(
+            debug_card_contour_image,
+            [min_area_bounding_rect_corners],
+            0,
+            (0, 0, 255),
+            3,
+            offset=(-x1, -y1),
+        )
+        cv2.drawContours(
+            debug_card_contour_image,
+            [card_contour],
+            0,
+            (0, 255, 0),
+            -1,
+            offset=(-x1, -y1),
+        )
+        debug_output.card_contour = debug_card_contour_image
 
     # make sure the contour is rectangular, i.e., it's very close in size to its own bounding box
     if (
-        cv2.contourArea(card_contour) / cv2.contourArea(min_area_bounding_rect_corners)
-        < 0.95
+        _rectangularity(card_contour, min_area_bounding_rect_corners)
+        < parameters.min_rectangularity
     ):
+        debug_output.rejected_by = REJECTED_BY_SHAPE
         return None, debug_output
 
-    (_, (rect_width, rect_height), _) = min_area_bounding_rect
-    if rect_width > rect_height:
-        undo_perspective_transform = cv2.getPerspectiveTransform(
-            np.float32(min_area_bounding_rect_corners),
-            parameters.reference_card_rect,
-        )
-    else:
-        undo_perspective_transform = cv2.getPerspectiveTransform(
-            np.float32(min_area_bounding_rect_corners),
-            parameters.reference_card_rect_rotated,
-        )
+    # a card cut off by the edge of the search rect would still look rectangular, so make
+    # sure it isn't touching any edge that's inside the image
+    box_x1, box_y1 = min_area_bounding_rect_corners.min(axis=0)
+    box_x2, box_y2 = min_area_bounding_rect_corners.max(axis=0)
+    if (
+        (x1 > 0 and box_x1 <= x1 + SEARCH_RECT_EDGE_MARGIN)
+        or (y1 > 0 and box_y1 <= y1 + SEARCH_RECT_EDGE_MARGIN)
+        or (x2 < full_width and box_x2 >= x2 - SEARCH_RECT_EDGE_MARGIN)
+        or (y2 < full_height and box_y2 >= y2 - SEARCH_RECT_EDGE_MARGIN)
+    ):
+        debug_output.rejected_by = REJECTED_BY_SHAPE
+        return None, debug_output
 
-    normalized_image = cv2.warpPerspective(
-        image,
-        undo_perspective_transform,
-        (parameters.card_width, parameters.card_height),
-    )
-    normalized_image = cv2.cvtColor(normalized_image, cv2.COLOR_BGR2BGRA)
+    debug_output.card_rect = min_area_bounding_rect
+
+    with metrics.timer("extract.warp"):
+        (_, (rect_width, rect_height), _) = min_area_bounding_rect
+        if rect_width > rect_height:
+            undo_perspective_transform = cv2.getPerspectiveTransform(
+                np.float32(min_area_bounding_rect_corners),
+                parameters.reference_card_rect,
+            )
+        else:
+            undo_perspective_transform = cv2.getPerspectiveTransform(
+                np.float32(min_area_bounding_rect_corners),
+                parameters.reference_card_rect_rotated,
+            )
+
+        normalized_image = cv2.warpPerspective(
+            full_image,
+            undo_perspective_transform,
+            (parameters.card_width, parameters.card_height),
+        )
+        normalized_image = cv2.cvtColor(normalized_image, cv2.COLOR_BGR2BGRA)
 
-    # reshape from (n, 1, 2) to (1, n, 2) to work with the transform
-    normalized_card_contour = cv2.perspectiveTransform(
-        card_contour.reshape(1, -1, 2).astype(np.float32), undo_perspective_transform
-    ).astype(np.int)
+        # reshape from (n, 1, 2) to (1, n, 2) to work with the transform
+        normalized_card_contour = cv2.perspectiveTransform(
+            card_contour.reshape(1, -1, 2).astype(np.float32),
+            undo_perspective_transform,
+        ).astype(np.int)
 
-    alpha_channel = np.zeros(normalized_image.shape[:2], dtype=np.uint8)
-    cv2.drawContours(alpha_channel, normalized_card_contour, 0, 255, -1)
-    alpha_channel = cv2.bitwise_and(alpha_channel, parameters.alpha_mask)
-    normalized_image[:, :, 3] = alpha_channel
+        alpha_channel = np.zeros(normalized_image.shape[:2], dtype=np.uint8)
+        cv2.drawContours(alpha_channel, normalized_card_contour, 0, 255, -1)
+        alpha_channel = cv2.bitwise_and(alpha_channel, parameters.alpha_mask)
+        normalized_image[:, :, 3] = alpha_channel
 
-    debug_output.alpha_channel = alpha_channel
-    debug_output.extracted_card = normalized_image
+    if debug:
+        debug_output.alpha_channel = alpha_channel
+        debug_output.extracted_card = normalized_image
 
     return normalized_image, debug_output
 
@@ -175,14 +330,38 @@ def extract_card_from_image(
 @dataclass
 class VideoExtractionParameters(ImageExtractionParameters):
     skip_frames: int = 5
-
-
-def extract_cards_from_video(
-    video: cv2.VideoCapture, parameters: VideoExtractionParameters
-) -> list[Image]:
-    extracted_images = []
-
-    for frame_number in tqdm(itertools.count()):
+    # consecutive frames show the card in nearly the same place, so only search a region
+    # around where it was last found, padded by this fraction of its size on each side
+    track_card: bool = True
+    tracking_padding: float = 0.1
+
+
+def _get_tracking_search_rect(
+    card_rect: tuple, image: Image, padding: float
+) -> SearchRect:
+    corners = cv2.boxPoints(card_rect)
+    pad = padding * max(card_rect[1])
+    height, width = image.shape[:2]
+    x1, y1 = np.maximum(np.floor(corners.min(axis=0) - pad).astype(int), 0)
+    x2, y2 = np.minimum(np.ceil(corners.max(axis=0) + pad).astype(int), (width, height))
+    return x1, y1, x2, y2
+
+
+def iter_cards_from_video(
+    video: cv2.VideoCapture,
+    parameters: VideoExtractionParameters,
+    *,
+    show_progress: bool = True,
+    rejections: Optional[Counter[str]] = None,
+) -> Iterator[Image]:
+    """
+    Yield each extracted card as soon as its frame has been processed, so that memory use
+    doesn't grow with the length of the video. If provided, rejections is updated with the
+    number of frames rejected by each stage.
+    """
+    search_rect: Optional[SearchRect] = None
+
+    for frame_number in tqdm(itertools.count(), disable=not show_progress):
         success, frame = video.read()
         if not success:
             break
@@ -190,8 +369,32 @@ def extract_cards_from_video(
         if frame_number % parameters.skip_frames != 0:
             continue
 
-        result, _ = extract_card_from_image(frame, parameters)
-        if result is not None:
-            extracted_images.append(result)
+        result, debug_output = extract_card_from_image(
+            frame, parameters, search_rect=search_rect
+        )
 
-    return extracted_images
+        if search_rect is not None and debug_output.rejected_by in (
+            REJECTED_BY_PREFILTER_SHAPE,
+            REJECTED_BY_SHAPE,
+        ):
+            # lost track of the card; look for it everywhere. (A frame that's rejected
+            # for being blurry would be just as blurry as a whole, so keep tracking.)
+            search_rect = None
+            result, debug_output = extract_card_from_image(frame, parameters)
+
+        metrics.count("extract.frames")
+        if result is not None:
+            metrics.count("extract.extracted")
+            if parameters.track_card:
+                # every card that's extracted was found in a card_rect
+                assert debug_output.card_rect is not None
+                search_rect = _get_tracking_search_rect(
+                    debug_output.card_rect, frame, parameters.tracking_padding
+                )
+            yield result
+        else:
+            # and every frame that isn't was rejected by some stage
+            assert debug_output.rejected_by is not None
+            metrics.count(f"extract.rejected_by.{debug_output.rejected_by}")
+            if rejections is not None:
+                rejections[debug_output.rejected_by] += 1
@@ -2,7 +2,10 @@ from typing import Optional
 import numpy as np
 import cv2
 from dataclasses import dataclass, field
+from functools import lru_cache
 from .types import Image, ConvexHull
+from .decks.base import CardGroup
+from . import metrics
 
 
 @dataclass
@@ -32,14 +35,81 @@ class FindConvexHullDebugOutput:
     hull_size: Optional[tuple[bool, int]] = None
 
 
+# reasons find_all may fail to find a hull for a rect
+REJECTED_NO_CONTOURS = "no_contours"
+REJECTED_HULL_AREA = "hull_area"
+
+
 def find(
-    image: Image, parameters: FindParameters
+    image: Image, parameters: FindParameters, *, debug: bool = False
 ) -> tuple[Optional[ConvexHull], FindConvexHullDebugOutput]:
+    """
+    The debug output is only filled in (and the contours only drawn) with debug=True.
+    """
+    debug_output = FindConvexHullDebugOutput()
+    hull, _ = _find_in_grayscale(
+        cv2.cvtColor(image, cv2.COLOR_BGR2GRAY),
+        parameters,
+        debug_output if debug else None,
+    )
+    return hull, debug_output
+
+
+@dataclass
+class FindAllResult:
+    # both in the same order as get_find_parameters
+    hulls: list[Optional[ConvexHull]]
+    rejections: list[Optional[str]]
+
+    @property
+    def all_found(self) -> bool:
+        return all(h is not None for h in self.hulls)
+
+
+@lru_cache(maxsize=None)
+def get_find_parameters(
+    group: CardGroup, card_width: int, card_height: int
+) -> tuple[FindParameters, ...]:
+    """
+    The parameters for every identifiable rect in group, in a consistent order. Cached,
+    since they're the same for every image of every card in the group.
+    """
+    return tuple(
+        FindParameters(
+            rect=r.as_nparray(card_width=card_width, card_height=card_height),
+            hull_area_range=r.hull_area_range,
+        )
+        for r in sorted(group.identifiable_rects)
+    )
+
+
+def find_all(image: Image, group: CardGroup) -> FindAllResult:
+    """
+    Find the hull in every identifiable rect of a card image, converting it to grayscale
+    only once.
+    """
+    card_height, card_width = image.shape[:2]
+    with metrics.timer("find.grayscale"):
+        grayscale = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    hulls = []
+    rejections = []
+    for parameters in get_find_parameters(group, card_width, card_height):
+        hull, rejection = _find_in_grayscale(grayscale, parameters)
+        hulls.append(hull)
+        rejections.append(rejection)
+        if rejection is not None:
+            metrics.count(f"find.rejected_by.{rejection}")
+    return FindAllResult(hulls=hulls, rejections=rejections)
+
+
+def _find_in_grayscale(
+    grayscale: Image,
+    parameters: FindParameters,
+    debug_output: Optional[FindConvexHullDebugOutput] = None,
+) -> tuple[Optional[ConvexHull], Optional[str]]:
     assert parameters.rect.shape == (4, 2)
     assert parameters.rect.dtype == np.int
 
-    debug_output = FindConvexHullDebugOutput()
-
     x1 = int(parameters.rect[0][0])
     y1 = int(parameters.rect[0][1])
     x2 = int(parameters.rect[2][0])
@@ -47,51 +117,57 @@ def find(
     width = x2 - x1
     height = y2 - y1
 
-    grayscale = cv2.cvtColor(image[y1:y2, x1:x2], cv2.COLOR_BGR2GRAY)
-    debug_output.grayscale = grayscale
-
-    thld = cv2.Canny(grayscale, 30, 200)
-    thld = cv2.dilate(thld, np.ones((2, 2), np.uint8), iterations=1)
-    debug_output.thld = thld
-
-    debug_output.accepted_contours = np.zeros_like(grayscale)
-    debug_output.rejected_contours = np.zeros_like(grayscale)
-
-    contours, _ = cv2.findContours(thld, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    merged_contour = None
-
-    for c in contours:
-        area = cv2.contourArea(c)
-        try:
-            solidity = float(area) / cv2.contourArea(cv2.convexHull(c))
-        except ZeroDivisionError:
-            cv2.drawContours(debug_output.rejected_contours, [c], 0, 255, 1)
-            continue
-
-        moments = cv2.moments(c)
-        centroid_x = int(moments["m10"] / moments["m00"])
-        centroid_y = int(moments["m01"] / moments["m00"])
-
-        centroid_in_bounds = (
-            abs(width / 2 - centroid_x)
-            < width * parameters.contour_centroid_horizontal_window / 2
-            and abs(height / 2 - centroid_y)
-            < height * parameters.contour_centroid_vertical_window / 2
-        )
-
-        if (
-            area >= parameters.min_contour_area
-            and centroid_in_bounds
-            and solidity >= parameters.min_contour_solidity
-        ):
-            cv2.drawContours(debug_output.accepted_contours, [c], 0, 255, 1)
-            if merged_contour is None:
-                merged_contour = c
-            else:
-                merged_contour = np.concatenate((merged_contour, c))
-        else:
-            cv2.drawContours(debug_output.rejected_contours, [c], 0, 255, 1)
+    with metrics.timer("find.crop"):
+        grayscale = grayscale[y1:y2, x1:x2]
+
+    with metrics.timer("find.canny"):
+        thld = cv2.Canny(grayscale, 30, 200)
+        thld = cv2.dilate(thld, np.ones((2, 2), np.uint8), iterations=1)
+
+    if debug_output is not None:
+        debug_output.grayscale = grayscale
+        debug_output.thld = thld
+        debug_output.accepted_contours = np.zeros_like(grayscale)
+        debug_output.rejected_contours = np.zeros_like(grayscale)
+
+    with metrics.timer("find.filter"):
+        contours, _ = cv2.findContours(thld, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        merged_contour = None
+
+        for c in contours:
+            area = cv2.contourArea(c)
+            try:
+                solidity = float(area) / cv2.contourArea(cv2.convexHull(c))
+            except ZeroDivisionError:
+                if debug_output is not None:
+                    cv2.drawContours(debug_output.rejected_contours, [c], 0, 255, 1)
+                continue
+
+            moments = cv2.moments(c)
+            centroid_x = int(moments["m10"] / moments["m00"])
+            centroid_y = int(moments["m01"] / moments["m00"])
+
+            centroid_in_bounds = (
+                abs(width / 2 - centroid_x)
+                < width * parameters.contour_centroid_horizontal_window / 2
+                and abs(height / 2 - centroid_y)
+                < height * parameters.contour_centroid_vertical_window / 2
+            )
+
+            if (
+                area >= parameters.min_contour_area
+                and centroid_in_bounds
+                and solidity >= parameters.min_contour_solidity
+            ):
+                if debug_output is not None:
+                    cv2.drawContours(debug_output.accepted_contours, [c], 0, 255, 1)
+                if merged_contour is None:
+                    merged_contour = c
+                else:
+                    merged_contour = np.concatenate((merged_contour, c))
+            elif debug_output is not None:
+                cv2.drawContours(debug_output.rejected_contours, [c], 0, 255, 1)
 
     if merged_contour is not None:
         hull = cv2.convexHull(merged_contour)
@@ -101,13 +177,14 @@ def find(
             hull_area < parameters.hull_area_range[0]
             or hull_area > parameters.hull_area_range[1]
         ):
-            hull = None
-            debug_output.hull_size = (False, hull_area)
-        else:
-            # translate back into the coordinate space of the original image
-            hull += parameters.rect[0]
+            if debug_output is not None:
+                debug_output.hull_size = (False, hull_area)
+            return None, REJECTED_HULL_AREA
+
+        # translate back into the coordinate space of the original image
+        hull += parameters.rect[0]
+        if debug_output is not None:
             debug_output.hull_size = (True, hull_area)
+        return hull, None
     else:
-        hull = None
-
-    return hull, debug_output
+        return None, REJECTED_NO_CONTOURS
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+from typing import Optional
+import os
+import numpy as np
+from dataclasses import dataclass, field
+from .types import ConvexHull
+from .util import atomic_write
+
+MANIFEST_FILENAME = "hulls.npz"
+
+
+@dataclass
+class HullManifestEntry:
+    card_name: str
+    # relative to the directory containing the manifest
+    image_path: str
+    image_mtime: float
+    # identifies the parameters the hulls were found with; see HullManifest.parameters
+    fingerprint: str
+    # one per identifiable rect, in rect order, or None if they could not all be found
+    hulls: Optional[list[ConvexHull]]
+
+
+@dataclass
+class HullManifest:
+    """
+    Every hull found for every image of a deck, stored as a single columnar table so that
+    it can be written atomically and read back in one go.
+    """
+
+    entries: dict[str, HullManifestEntry] = field(default_factory=dict)
+    # fingerprint -> description of the parameters it identifies
+    parameters: dict[str, str] = field(default_factory=dict)
+
+    @staticmethod
+    def load(directory: str) -> HullManifest:
+        try:
+            with np.load(os.path.join(directory, MANIFEST_FILENAME)) as f:
+                columns = {k: f[k] for k in f.files}
+        except FileNotFoundError:
+            return HullManifest()
+
+        card_names = columns["card_names"].tolist()
+        fingerprints = columns["fingerprints"].tolist()
+        image_hull_offsets = columns["image_hull_offsets"]
+        hull_offsets = columns["hull_offsets"]
+        hull_points = columns["hull_points"]
+
+        entries = {}
+        for i, (path, card_id, mtime, fingerprint_id) in enumerate(
+            zip(
+                columns["image_paths"].tolist(),
+                columns["image_card_ids"].tolist(),
+                columns["image_mtimes"].tolist(),
+                columns["image_fingerprint_ids"].tolist(),
+            )
+        ):
+            first_hull, last_hull = image_hull_offsets[i], image_hull_offsets[i + 1]
+            entries[path] = HullManifestEntry(
+                card_name=card_names[card_id],
+                image_path=path,
+                image_mtime=mtime,
+                fingerprint=fingerprints[fingerprint_id],
+                hulls=[
+                    hull_points[hull_offsets[h] : hull_offsets[h + 1]].reshape(-1, 1, 2)
+                    for h in range(first_hull, last_hull)
+                ]
+                # every rect has a hull, so no hulls at all means they weren't found
+                or None,
+            )
+
+        return HullManifest(
+            entries=entries,
+            parameters=dict(zip(fingerprints, columns["parameters"].tolist())),
+        )
+
+    def save(self, directory: str):
+        entries = list(self.entries.values())
+        card_names = sorted({e.card_name for e in entries})
+        card_ids = {name: i for i, name in enumerate(card_names)}
+        fingerprints = sorted(self.parameters)
+        fingerprint_ids = {f: i for i, f in enumerate(fingerprints)}
+        image_hulls = [e.hulls or [] for e in entries]
+        hulls = [h.reshape(-1, 2) for hs in image_hulls for h in hs]
+
+        with atomic_write(os.path.join(directory, MANIFEST_FILENAME)) as f:
+            np.savez(
+                f,
+                card_names=np.array(card_names, dtype=str),
+                fingerprints=np.array(fingerprints, dtype=str),
+                parameters=np.array(
+                    [self.parameters[f] for f in fingerprints], dtype=str
+                ),
+                image_paths=np.array([e.image_path for e in entries], dtype=str),
+                image_card_ids=np.array(
+                    [card_ids[e.card_name] for e in entries], dtype=np.int32
+                ),
+                image_mtimes=np.array(
+                    [e.image_mtime for e in entries], dtype=np.float64
+                ),
+                image_fingerprint_ids=np.array(
+                    [fingerprint_ids[e.fingerprint] for e in entries], dtype=np.int32
+                ),
+                image_hull_offsets=np.cumsum(
+                    [0] + [len(hs) for hs in image_hulls], dtype=np.int64
+                ),
+                hull_rect_indices=np.array(
+                    [i for hs in image_hulls for i in range(len(hs))], dtype=np.int16
+                ),
+                hull_offsets=np.cumsum([0] + [len(h) for h in hulls], dtype=np.int64),
+                hull_points=(
+                    np.concatenate(hulls).astype(np.int32)
+                    if hulls
+                    else np.zeros((0, 2), dtype=np.int32)
+                ),
+            )
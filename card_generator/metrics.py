@@ -0,0 +1,195 @@
+"""
+Named stage timers, counters and gauges for the batch pipelines. Disabled by default, in
+which case timer() hands back a shared no-op context manager and count() returns straight
+away, so instrumented code costs next to nothing outside of a measured run.
+
+State is per process; map functions over worker pools with imap(), or wrap them with
+collecting() and pass what they return through merge_results(), so that the parent sees
+every worker's measurements.
+"""
+
+from __future__ import annotations
+
+from typing import Callable, Generic, Iterable, Iterator, TypeVar
+from collections import defaultdict
+from contextlib import nullcontext
+import multiprocessing.pool
+import resource
+import sys
+import time
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# name -> [calls, total seconds, max seconds]
+_timers: defaultdict[str, list[float]] = defaultdict(lambda: [0, 0.0, 0.0])
+_counters: defaultdict[str, int] = defaultdict(int)
+# name -> value; merged by taking the max, which suits peak memory
+_gauges: dict[str, float] = {}
+_enabled = False
+
+_NULL_TIMER = nullcontext()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_):
+        elapsed = time.perf_counter() - self.start
+        timer = _timers[self.name]
+        timer[0] += 1
+        timer[1] += elapsed
+        timer[2] = max(timer[2], elapsed)
+
+
+def timer(name: str):
+    return _Timer(name) if _enabled else _NULL_TIMER
+
+
+def count(name: str, n: int = 1):
+    if _enabled:
+        _counters[name] += n
+
+
+def gauge_max(name: str, value: float):
+    if _enabled:
+        _gauges[name] = max(_gauges.get(name, value), value)
+
+
+def record_peak_rss():
+    # gauges merge by max, so across a pool this ends up as the largest single process
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    gauge_max(
+        "peak_rss_bytes", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    )
+    gauge_max(
+        "peak_rss_children_bytes",
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit,
+    )
+
+
+def snapshot() -> dict:
+    return {
+        "timers": {
+            name: {"calls": int(calls), "total_s": total, "max_s": longest}
+            for name, (calls, total, longest) in sorted(_timers.items())
+        },
+        "counters": dict(sorted(_counters.items())),
+        "gauges": dict(sorted(_gauges.items())),
+    }
+
+
+def take() -> dict:
+    """
+    Snapshot and reset this process's measurements.
+    """
+    result = snapshot()
+    _timers.clear()
+    _counters.clear()
+    _gauges.clear()
+    return result
+
+
+def merge(other: dict):
+    for name, t in other["timers"].items():
+        timer = _timers[name]
+        timer[0] += t["calls"]
+        timer[1] += t["total_s"]
+        timer[2] = max(timer[2], t["max_s"])
+    for name, n in other["counters"].items():
+        _counters[name] += n
+    for name, value in other["gauges"].items():
+        _gauges[name] = max(_gauges.get(name, value), value)
+
+
+class _Collecting(Generic[T, R]):
+    # a class rather than a closure, so that it can be pickled over to pool workers
+    def __init__(self, fn: Callable[[T], R]):
+        self.fn = fn
+
+    def __call__(self, item: T) -> tuple[R, dict]:
+        # workers that were spawned rather than forked start out disabled
+        enable()
+        result = self.fn(item)
+        record_peak_rss()
+        return result, take()
+
+
+def collecting(fn: Callable[[T], R]) -> Callable[[T], tuple[R, dict]]:
+    """
+    Wrap fn so that it also returns (and resets) the measurements made while it ran. Only
+    call this while enabled, and unwrap the results with merge_results().
+    """
+    return _Collecting(fn)
+
+
+def merge_results(results: Iterable[tuple[R, dict]]) -> Iterator[R]:
+    for result, measurements in results:
+        merge(measurements)
+        yield result
+
+
+def imap(
+    pool: multiprocessing.pool.Pool,
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    chunk_size: int = 1,
+    *,
+    ordered: bool = False,
+) -> Iterator[R]:
+    """
+    pool.imap_unordered, or pool.imap if ordered, that brings each worker's measurements
+    back along with its results while enabled.
+    """
+    map_fn = pool.imap if ordered else pool.imap_unordered
+    if is_enabled():
+        yield from merge_results(map_fn(collecting(fn), items, chunk_size))
+    else:
+        yield from map_fn(fn, items, chunk_size)
+
+
+def to_prometheus(measurements: dict, prefix: str = "card_generator") -> str:
+    lines = [
+        f"# TYPE {prefix}_stage_calls_total counter",
+        *(
+            f'{prefix}_stage_calls_total{{stage="{name}"}} {t["calls"]}'
+            for name, t in measurements["timers"].items()
+        ),
+        f"# TYPE {prefix}_stage_seconds_total counter",
+        *(
+            f'{prefix}_stage_seconds_total{{stage="{name}"}} {t["total_s"]}'
+            for name, t in measurements["timers"].items()
+        ),
+        f"# TYPE {prefix}_stage_max_seconds gauge",
+        *(
+            f'{prefix}_stage_max_seconds{{stage="{name}"}} {t["max_s"]}'
+            for name, t in measurements["timers"].items()
+        ),
+        f"# TYPE {prefix}_events_total counter",
+        *(
+            f'{prefix}_events_total{{name="{name}"}} {n}'
+            for name, n in measurements["counters"].items()
+        ),
+        *(
+            line
+            for name, value in measurements["gauges"].items()
+            for line in (f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {value}")
+        ),
+    ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+from typing import Optional
+import os
+import numpy as np
+import cv2
+from dataclasses import dataclass, field
+from .types import Image
+from .util import atomic_write
+
+INDEX_FILENAME = "perceptual_hashes.npz"
+
+
+def perceptual_hash(image: Image) -> int:
+    """
+    64-bit DCT hash: which of the lowest-frequency components of a tiny grayscale copy of
+    the image are above their median. Near-identical images have hashes that differ in only
+    a few bits.
+    """
+    grayscale = cv2.cvtColor(image[:, :, :3], cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(grayscale, (32, 32), interpolation=cv2.INTER_AREA)
+    low_frequencies = cv2.dct(small.astype(np.float32))[:8, :8].ravel()
+    # the DC term is just the average brightness, so leave it out of the median
+    bits = low_frequencies > np.median(low_frequencies[1:])
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+@dataclass
+class PerceptualHashIndex:
+    """
+    The perceptual hashes of the images in a directory, persisted alongside them so that
+    near-duplicates can be recognized across runs.
+    """
+
+    # hashes at most this many bits apart are duplicates; negative to never match
+    max_distance: int
+    _filenames: list[str] = field(default_factory=list)
+    _hashes: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.uint64))
+
+    @staticmethod
+    def load(directory: str, max_distance: int) -> PerceptualHashIndex:
+        try:
+            with np.load(os.path.join(directory, INDEX_FILENAME)) as f:
+                filenames, hashes = f["filenames"], f["hashes"]
+        except FileNotFoundError:
+            return PerceptualHashIndex(max_distance=max_distance)
+
+        # forget about any images that have since been deleted
+        exists = np.array(
+            [os.path.exists(os.path.join(directory, f)) for f in filenames], dtype=bool
+        )
+        return PerceptualHashIndex(
+            max_distance=max_distance,
+            _filenames=[str(f) for f in filenames[exists]],
+            _hashes=hashes[exists],
+        )
+
+    def save(self, directory: str):
+        with atomic_write(os.path.join(directory, INDEX_FILENAME)) as f:
+            np.savez(
+                f, filenames=np.array(self._filenames, dtype=str), hashes=self._hashes
+            )
+
+    def find_duplicate(self, image_hash: int) -> Optional[str]:
+        if self.max_distance < 0 or len(self._hashes) == 0:
+            return None
+        differing_bits = np.unpackbits(
+            (self._hashes ^ np.uint64(image_hash)).view(np.uint8)
+        ).reshape(-1, 64)
+        distances = differing_bits.sum(axis=1)
+        closest = int(np.argmin(distances))
+        return (
+            self._filenames[closest]
+            if distances[closest] <= self.max_distance
+            else None
+        )
+
+    def add(self, filename: str, image_hash: int):
+        self._filenames.append(filename)
+        self._hashes = np.append(self._hashes, np.uint64(image_hash))
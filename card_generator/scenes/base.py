@@ -1,11 +1,14 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+import numpy as np
 import imgaug as ia
-from ..types import Image, ConvexHull
+from ..types import Image
 from ..decks.base import Deck
 from .image_source import BackgroundImageSource, CardImageSource
 
 Scene = tuple[Image, ia.BoundingBoxesOnImage]
+# (batch size, height, width, 3) uint8 images, and the bounding boxes of each
+Batch = tuple[np.ndarray, list[ia.BoundingBoxesOnImage]]
 
 
 @dataclass
@@ -20,12 +23,16 @@ class SceneGenerator(ABC):
         assert self.width > self.deck.width * 2
         assert self.height > self.deck.height * 2
 
-    def hull_to_keypoints(self, hull: ConvexHull, *, dx: int = 0, dy: int = 0):
-        return ia.KeypointsOnImage(
-            [ia.Keypoint(x=x + dx, y=y + dy) for x, y in hull.reshape(-1, 2)],
-            shape=(self.height, self.width, 3),
-        )
-
     @abstractmethod
-    def generate_scene(self, n: int) -> Scene:
-        ...
+    def generate_scene(self, n: int) -> Scene: ...
+
+    def generate_batch(self, batch_size: int, n: int) -> Batch:
+        """
+        batch_size scenes of n cards each, stacked into one array.
+        """
+        images = np.empty((batch_size, self.height, self.width, 3), dtype=np.uint8)
+        bounding_boxes = []
+        for i in range(batch_size):
+            images[i], scene_bounding_boxes = self.generate_scene(n)
+            bounding_boxes.append(scene_bounding_boxes)
+        return images, bounding_boxes
@@ -1,13 +1,15 @@
+from typing import Optional
 import math
 import numpy as np
+import cv2
 from dataclasses import dataclass, field
-import itertools
 import imgaug as ia
-from imgaug import augmenters as iaa
-from imgaug import parameters as iap
+import imgaug.random as iarandom
 from .image_source import CardWithMetadata
-from .base import SceneGenerator, Scene
+from .base import SceneGenerator, Scene, Batch
+from .transforms import Transform, translate, rotate, scale, transform_points
 from ..util import show_images_in_windows
+from .. import metrics
 from ..types import ConvexHull, Image
 
 MAX_FAN_ANGLE = 15
@@ -17,98 +19,366 @@ BOUNDING_BOX_BUFFER = 3
 @dataclass
 class CardInFan:
     name: str
+    # the untransformed, card-sized image; it's only ever warped into the scene region it
+    # covers, see composite_onto
     image: Image
-    tilt_degrees: int
-    keypoint_groups: list[ia.KeypointsOnImage]
-
-    def augment(self, deterministic_aug: iaa.Augmenter):
-        # this function should NOT call to_deterministic, because in so doing it loses
-        # the state of the input and creates a new deterministic augmentation with a new
-        # seed -- meaning that it won't have the same seed as sibling CardInFans
-        self.image = deterministic_aug.augment_image(self.image)
-        # do this one at a time in order to ensure determinism is the same for all of them
-        self.keypoint_groups = [
-            deterministic_aug.augment_keypoints(k) for k in self.keypoint_groups
-        ]
-
-    def get_bounding_boxes(self, width: int, height: int) -> list[ia.BoundingBox]:
-        bounding_boxes = []
-        for group in self.keypoint_groups:
-            group_x = [k.x for k in group]
-            min_x = max(0, int(min(group_x) - BOUNDING_BOX_BUFFER))
-            max_x = min(width, int(max(group_x) + BOUNDING_BOX_BUFFER))
-
-            group_y = [k.y for k in group]
-            min_y = max(0, int(min(group_y) - BOUNDING_BOX_BUFFER))
-            max_y = min(height, int(max(group_y) + BOUNDING_BOX_BUFFER))
-
-            bounding_boxes.append(
-                ia.BoundingBox(x1=min_x, y1=min_y, x2=max_x, y2=max_y, label=self.name)
+    tilt_degrees: float
+    # (groups, points, 2) x, y of each hull's vertices in the coordinate space of the
+    # untransformed image; see hulls_to_keypoint_groups
+    keypoint_groups: np.ndarray
+    # card space -> scene space
+    transform: Transform = field(default_factory=lambda: np.eye(3))
+
+    def compose(self, transform: Transform):
+        self.transform = transform @ self.transform
+
+    def get_scene_roi(
+        self, width: int, height: int
+    ) -> Optional[tuple[int, int, int, int]]:
+        """
+        Bounding box (x1, y1, x2, y2) of the transformed card, clipped to the scene, or None
+        if the card is entirely outside of it.
+        """
+        card_height, card_width = self.image.shape[:2]
+        corners = transform_points(
+            self.transform,
+            np.array(
+                [[0, 0], [card_width, 0], [card_width, card_height], [0, card_height]],
+                dtype=np.float64,
+            ),
+        )
+        x1, y1 = np.maximum(np.floor(corners.min(axis=0)).astype(int), 0)
+        x2, y2 = np.minimum(np.ceil(corners.max(axis=0)).astype(int), (width, height))
+        if x1 >= x2 or y1 >= y2:
+            return None
+        return x1, y1, x2, y2
+
+    def composite_onto(self, scene: Image):
+        """
+        Alpha-blend the transformed card onto the scene in place. Only the region the card
+        covers is warped or touched.
+        """
+        height, width = scene.shape[:2]
+        roi = self.get_scene_roi(width, height)
+        if roi is None:
+            return
+        x1, y1, x2, y2 = roi
+
+        warped = cv2.warpAffine(
+            self.image,
+            (translate(-x1, -y1) @ self.transform)[:2],
+            (x2 - x1, y2 - y1),
+            flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=(0, 0, 0, 0),
+        )
+        alpha = warped[:, :, 3:] * np.float32(1 / 255)
+        target = scene[y1:y2, x1:x2]
+        target[:] = target * (1 - alpha) + warped[:, :, :3] * alpha + 0.5
+
+    def warp_keypoint_groups(self) -> np.ndarray:
+        """
+        The keypoint groups in scene space, in the same (groups, points, 2) layout.
+        """
+        return transform_points(
+            self.transform, self.keypoint_groups.reshape(-1, 2)
+        ).reshape(self.keypoint_groups.shape)
+
+
+def hulls_to_keypoint_groups(hulls: list[ConvexHull]) -> np.ndarray:
+    """
+    Stack hulls into a (groups, points, 2) array. Hulls with fewer vertices than the
+    largest are padded by repeating their last vertex, which leaves their extent unchanged.
+    """
+    groups = np.empty((len(hulls), max(len(h) for h in hulls), 2), dtype=np.float64)
+    for group, hull in zip(groups, hulls):
+        group[: len(hull)] = hull.reshape(-1, 2)
+        group[len(hull) :] = group[len(hull) - 1]
+    return groups
+
+
+def get_bounding_boxes(
+    cards: list[CardInFan], width: int, height: int
+) -> list[ia.BoundingBox]:
+    """
+    The bounding box of every keypoint group of every card in scene space, computed for
+    all of the cards at once and only turned into imgaug objects at the end.
+    """
+    if not cards:
+        return []
+
+    # (cards, 3, 3) and (cards, groups, points, 2); cards of different groups can have
+    # different numbers of groups and points, so pad those out to the largest too
+    n_groups = max(c.keypoint_groups.shape[0] for c in cards)
+    n_points = max(c.keypoint_groups.shape[1] for c in cards)
+    transforms = np.stack([c.transform for c in cards])
+    points = np.empty((len(cards), n_groups, n_points, 2), dtype=np.float64)
+    for card_points, c in zip(points, cards):
+        groups, group_points, _ = c.keypoint_groups.shape
+        card_points[:groups, :group_points] = c.keypoint_groups
+        card_points[:groups, group_points:] = c.keypoint_groups[:, -1:]
+        card_points[groups:] = card_points[groups - 1]
+
+    scene_points = (
+        np.einsum("cij,cgpj->cgpi", transforms[:, :2, :2], points)
+        + transforms[:, None, None, :2, 2]
+    )
+
+    # truncate like int() would, then clip to the scene
+    top_left = np.maximum(np.trunc(scene_points.min(axis=2) - BOUNDING_BOX_BUFFER), 0)
+    bottom_right = np.minimum(
+        np.trunc(scene_points.max(axis=2) + BOUNDING_BOX_BUFFER), (width, height)
+    )
+    # (cards, groups, 4) as plain ints
+    boxes = np.concatenate((top_left, bottom_right), axis=2).astype(int).tolist()
+
+    return [
+        ia.BoundingBox(*boxes[i][g], label=c.name)
+        for i, c in enumerate(cards)
+        for g in range(c.keypoint_groups.shape[0])
+    ]
+
+
+def measure_visibility(
+    cards: list[CardInFan], width: int, height: int, resolution: float
+) -> tuple[list[np.ndarray], list[np.ndarray]]:
+    """
+    How much of each keypoint group is left showing once every card is in place, judged
+    from the card outlines alone: draw each card's quad into a label buffer at a fraction
+    of the scene's resolution in z-order, then count how many of each group's pixels are
+    still labelled with its own card (and lie inside the scene).
+
+    Returns, per card, the visible fraction of each group, and the (x1, y1, x2, y2) scene
+    space extent of the visible part of each group (nan if none of it is visible).
+    """
+    assert len(cards) < 255
+
+    # leave a margin around the scene, so that parts of hulls that fall outside of it are
+    # still drawn (and counted as hidden) rather than being clipped away
+    margin_x, margin_y = width / 2, height / 2
+    to_buffer = scale(resolution) @ translate(margin_x, margin_y)
+    labels = np.zeros(
+        (math.ceil(2 * height * resolution), math.ceil(2 * width * resolution)),
+        dtype=np.uint8,
+    )
+    # draw with sub-pixel precision, since the buffer is so coarse
+    shift = 4
+
+    def to_fixed_point(points: np.ndarray) -> np.ndarray:
+        return np.round(points * (1 << shift)).astype(np.int32)
+
+    for i, c in enumerate(cards):
+        card_height, card_width = c.image.shape[:2]
+        corners = transform_points(
+            to_buffer @ c.transform,
+            np.array(
+                [[0, 0], [card_width, 0], [card_width, card_height], [0, card_height]],
+                dtype=np.float64,
+            ),
+        )
+        cv2.fillPoly(labels, [to_fixed_point(corners)], (i + 1,), shift=shift)
+
+    # anything outside of the scene isn't visible, whichever card is there
+    scene_x1 = math.floor(margin_x * resolution)
+    scene_y1 = math.floor(margin_y * resolution)
+    scene_x2 = math.ceil((margin_x + width) * resolution)
+    scene_y2 = math.ceil((margin_y + height) * resolution)
+    labels[:scene_y1] = 0
+    labels[scene_y2:] = 0
+    labels[:, :scene_x1] = 0
+    labels[:, scene_x2:] = 0
+
+    buffer_height, buffer_width = labels.shape
+    fractions = []
+    extents = []
+    for i, c in enumerate(cards):
+        groups = transform_points(
+            to_buffer @ c.transform, c.keypoint_groups.reshape(-1, 2)
+        ).reshape(c.keypoint_groups.shape)
+        card_fractions = np.zeros(len(groups))
+        card_extents = np.full((len(groups), 4), np.nan)
+
+        for g, group in enumerate(groups):
+            x1, y1 = np.clip(np.floor(group.min(axis=0)).astype(int), 0, None)
+            x2 = min(int(np.ceil(group[:, 0].max())) + 1, buffer_width)
+            y2 = min(int(np.ceil(group[:, 1].max())) + 1, buffer_height)
+            if x1 >= x2 or y1 >= y2:
+                continue
+
+            mask = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+            cv2.fillPoly(mask, [to_fixed_point(group - (x1, y1))], (1,), shift=shift)
+            visible = (mask == 1) & (labels[y1:y2, x1:x2] == i + 1)
+            total = np.count_nonzero(mask)
+            if total == 0:
+                continue
+            card_fractions[g] = np.count_nonzero(visible) / total
+
+            ys, xs = np.nonzero(visible)
+            if len(xs) > 0:
+                card_extents[g] = (
+                    (x1 + xs.min()) / resolution - margin_x,
+                    (y1 + ys.min()) / resolution - margin_y,
+                    (x1 + xs.max() + 1) / resolution - margin_x,
+                    (y1 + ys.max() + 1) / resolution - margin_y,
+                )
+
+        fractions.append(card_fractions)
+        extents.append(card_extents)
+
+    return fractions, extents
+
+
+def trim_occluded_boxes(
+    bounding_boxes: list[ia.BoundingBox],
+    fractions: list[np.ndarray],
+    extents: list[np.ndarray],
+    min_visible_fraction: float,
+    slack: float,
+) -> list[ia.BoundingBox]:
+    """
+    Drop the boxes (in the order get_bounding_boxes returns them) of groups that are less
+    than min_visible_fraction visible, and shrink the rest to the visible extent of their
+    group, grown by slack on every side. Groups with nothing visible at all are always
+    dropped, even with a min_visible_fraction of 0, since there's nothing left to box.
+    """
+    trimmed = []
+    for box, fraction, extent in zip(
+        bounding_boxes, np.concatenate(fractions), np.concatenate(extents)
+    ):
+        # a group's extent is nan when none of it is visible
+        if fraction < min_visible_fraction or np.isnan(extent).any():
+            continue
+        x1, y1, x2, y2 = extent
+        trimmed.append(
+            ia.BoundingBox(
+                x1=max(box.x1, int(x1 - slack)),
+                y1=max(box.y1, int(y1 - slack)),
+                x2=min(box.x2, int(math.ceil(x2 + slack))),
+                y2=min(box.y2, int(math.ceil(y2 + slack))),
+                label=box.label,
             )
-        return bounding_boxes
+        )
+    return trimmed
 
 
+@dataclass
 class FannedSceneGenerator(SceneGenerator):
+    # a keypoint group counts as visible if at least this fraction of it isn't covered by
+    # later cards or cut off by the edge of the scene; the boxes of groups that aren't are
+    # dropped, and a layout in which any card has no visible groups at all is redrawn...
+    min_visible_fraction: float = 0.5
+    # ...up to this many times, after which the last layout is used anyway
+    max_layout_attempts: int = 10
+    # visibility is judged from a label buffer drawn at this fraction of the resolution
+    occlusion_resolution: float = 0.25
+
     def generate_scene(self, n: int) -> Scene:
-        cards_in_fan = [self._to_card_in_fan(c) for c in self.cards.get_random_cards(n)]
+        images, bounding_boxes = self.generate_batch(1, n)
+        return images[0], bounding_boxes[0]
 
-        resize_background = iaa.Resize({"height": self.height, "width": self.width})
+    def generate_batch(self, batch_size: int, n: int) -> Batch:
+        """
+        The random layout parameters of every scene in the batch are drawn together, and
+        the fans' transforms built for all of the scenes at once.
+        """
+        # every random parameter is drawn from imgaug's global RNG, so ia.seed() fully
+        # determines the batch (along with the stdlib RNG, used to pick cards)
+        rng = iarandom.get_global_rng().generator
 
-        for i, c in enumerate(cards_in_fan):
-            fan_remaining_cards_aug = iaa.Sequential(
-                [
-                    self._get_tilt_augmentation(c.tilt_degrees),
-                    self._get_jitter_augmentation(),
-                ]
-            ).to_deterministic()
+        cards = [self.cards.get_random_cards(n) for _ in range(batch_size)]
+        metrics.count("scene.cards", batch_size * n)
 
-            for later_card in cards_in_fan[i + 1 :]:
-                later_card.augment(fan_remaining_cards_aug)
+        with metrics.timer("scene.augment"):
+            fans = self._lay_out_fans(cards, rng)
 
-        hand_aug = self._get_whole_hand_augmentation().to_deterministic()
-        for c in cards_in_fan:
-            c.augment(hand_aug)
+        images = np.empty((batch_size, self.height, self.width, 3), dtype=np.uint8)
+        all_bounding_boxes = []
+        for scene_cards, cards_in_fan, image in zip(cards, fans, images):
+            # redraw any layout that leaves a card with no visible groups at all
+            for attempt in range(self.max_layout_attempts):
+                if attempt > 0:
+                    metrics.count("scene.rejected_layouts")
+                    with metrics.timer("scene.augment"):
+                        (cards_in_fan,) = self._lay_out_fans([scene_cards], rng)
+                with metrics.timer("scene.occlusion"):
+                    fractions, extents = measure_visibility(
+                        cards_in_fan,
+                        self.width,
+                        self.height,
+                        self.occlusion_resolution,
+                    )
+                if all((f >= self.min_visible_fraction).any() for f in fractions):
+                    break
 
-        # TODO: reject any fans that obscure all keypoint_groups by n%
-        # TODO: remove any bounding boxes that are not visible
-        # TODO: should shrink bounding boxes that are partially obscured?
+            with metrics.timer("scene.background"):
+                self.backgrounds.fill_with_random_crop(image)
 
-        result = resize_background.augment_image(
-            self.backgrounds.get_random_background()
-        )
-        for c in cards_in_fan:
-            # no idea what's going on here
-            mask = c.image[:, :, 3]
-            mask = np.stack([mask] * 3, -1)
-            result = np.where(mask, c.image[:, :, :3], result)
-
-        bounding_boxes = ia.BoundingBoxesOnImage(
-            list(
-                itertools.chain.from_iterable(
-                    c.get_bounding_boxes(self.width, self.height) for c in cards_in_fan
+            with metrics.timer("scene.composite"):
+                for c in cards_in_fan:
+                    c.composite_onto(image)
+
+            with metrics.timer("scene.bbox"):
+                scene_bounding_boxes = get_bounding_boxes(
+                    cards_in_fan, self.width, self.height
                 )
-            ),
-            result.shape,
+                visible_bounding_boxes = trim_occluded_boxes(
+                    scene_bounding_boxes,
+                    fractions,
+                    extents,
+                    self.min_visible_fraction,
+                    # a label buffer pixel, plus the usual margin
+                    1 / self.occlusion_resolution + BOUNDING_BOX_BUFFER,
+                )
+                metrics.count(
+                    "scene.occluded_boxes",
+                    len(scene_bounding_boxes) - len(visible_bounding_boxes),
+                )
+                all_bounding_boxes.append(
+                    ia.BoundingBoxesOnImage(visible_bounding_boxes, image.shape)
+                )
+
+        return images, all_bounding_boxes
+
+    def _lay_out_fans(
+        self, cards: list[list[CardWithMetadata]], rng: np.random.Generator
+    ) -> list[list[CardInFan]]:
+        """
+        Place the cards of each of a batch of scenes in a fan, with every scene's random
+        parameters drawn at once.
+        """
+        fans = [[self._to_card_in_fan(c) for c in scene_cards] for scene_cards in cards]
+        batch_size, n = len(fans), len(fans[0])
+
+        # (batch size, n, 3, 3): each card's tilt+jitter applies to every card after it
+        steps = self._get_jitter_transforms((batch_size, n), rng) @ (
+            self._get_tilt_transforms(
+                np.array([[c.tilt_degrees for c in fan] for fan in fans]), rng
+            )
         )
+        # (batch size, 3, 3)
+        hand_transforms = self._get_whole_hand_transforms(batch_size, rng)
+
+        # accumulate the tilts+jitters into a running transform, instead of re-warping the
+        # later cards once per earlier card
+        fan_transforms = np.broadcast_to(np.eye(3), (batch_size, 3, 3))
+        for i in range(n):
+            transforms = hand_transforms @ fan_transforms
+            for fan, transform in zip(fans, transforms):
+                fan[i].compose(transform)
+            fan_transforms = steps[:, i] @ fan_transforms
 
-        return result, bounding_boxes
+        return fans
 
     def _to_card_in_fan(self, card: CardWithMetadata):
-        # new empty canvas
-        image = np.zeros((self.height, self.width, 4), dtype=np.uint8)
-        # TODO: This can be probably be a canvas based solely on the size of the card,
-        # and then clamped to the desired size later.
         top = int(self.height / 2 - self.deck.height / 2)
         left = int(self.width / 2 - self.deck.width / 2)
-        # paste the card into the middle
-        image[top : top + self.deck.height, left : left + self.deck.width] = card.image
         return CardInFan(
             name=card.name,
-            image=image,
+            image=card.image,
             tilt_degrees=self._get_tilt_degrees(card.hulls),
-            keypoint_groups=[
-                self.hull_to_keypoints(h, dx=left, dy=top) for h in card.hulls
-            ],
+            keypoint_groups=hulls_to_keypoint_groups(card.hulls),
+            # place the card in the middle of the scene
+            transform=translate(left, top),
         )
 
     def _get_tilt_degrees(self, card_hulls: list[ConvexHull]):
@@ -119,49 +389,38 @@ class FannedSceneGenerator(SceneGenerator):
         cosine = max_y / math.hypot(max_x, max_y)
         return math.degrees(math.acos(cosine))
 
-    def _get_tilt_augmentation(self, degrees: int):
+    def _get_tilt_transforms(self, degrees: np.ndarray, rng: np.random.Generator):
         # 0.9 -> sometimes players hold their cards slightly overlapping
         # 1.3 -> but more often they leave a lot of extra space
-        min_degrees, max_degrees = degrees * 0.9, min(degrees * 1.3, MAX_FAN_ANGLE)
-
-        # we want to rotate from the bottom-left corner, so have to translate back and forth
-        return iaa.Sequential(
-            [
-                iaa.Affine(
-                    translate_px={
-                        "x": int(self.deck.width / 2),
-                        "y": int(-self.deck.height / 2),
-                    }
-                ),
-                iaa.Affine(
-                    rotate=iap.Normal(
-                        (min_degrees + max_degrees) / 2, (max_degrees - min_degrees) / 2
-                    )
-                ),
-                iaa.Affine(
-                    translate_px={
-                        "x": int(-self.deck.width / 2),
-                        "y": int(self.deck.height / 2),
-                    }
-                ),
-            ]
+        min_degrees = degrees * 0.9
+        max_degrees = np.minimum(degrees * 1.3, MAX_FAN_ANGLE)
+
+        # we want to rotate from the bottom-left corner of the centered card
+        return rotate(
+            rng.normal(
+                (min_degrees + max_degrees) / 2, np.abs(max_degrees - min_degrees) / 2
+            ),
+            cx=(self.width - self.deck.width) / 2,
+            cy=(self.height + self.deck.height) / 2,
         )
 
-    def _get_jitter_augmentation(self):
-        return iaa.Affine(
-            translate_px={
-                "x": iap.Normal(0, int(self.deck.width * 0.03)),
-                "y": iap.Normal(
-                    int(self.deck.height * 0.02), int(self.deck.height * 0.03)
-                ),
-            }
+    def _get_jitter_transforms(self, shape: tuple[int, ...], rng: np.random.Generator):
+        return translate(
+            np.round(rng.normal(0, int(self.deck.width * 0.03), shape)),
+            np.round(
+                rng.normal(
+                    int(self.deck.height * 0.02), int(self.deck.height * 0.03), shape
+                )
+            ),
         )
 
-    def _get_whole_hand_augmentation(self):
-        return iaa.Sequential(
-            [
-                iaa.Affine(scale=(0.65, 1)),
-                iaa.Affine(rotate=(-180, 180)),
-                iaa.Affine(translate_percent={"x": (-0.2, 0.2), "y": (-0.2, 0.2)}),
-            ]
+    def _get_whole_hand_transforms(self, batch_size: int, rng: np.random.Generator):
+        cx, cy = self.width / 2, self.height / 2
+        return (
+            translate(
+                rng.uniform(-0.2, 0.2, batch_size) * self.width,
+                rng.uniform(-0.2, 0.2, batch_size) * self.height,
+            )
+            @ rotate(rng.uniform(-180, 180, batch_size), cx=cx, cy=cy)
+            @ scale(rng.uniform(0.65, 1, batch_size), cx=cx, cy=cy)
         )
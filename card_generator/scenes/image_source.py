@@ -1,18 +1,46 @@
 from __future__ import annotations
 
+from typing import IO, Callable, Iterable, Optional, Union
+from collections import OrderedDict
 import numpy as np
-from dataclasses import dataclass
+import cv2
+from dataclasses import dataclass, field
 import os
+import itertools
 from glob import glob
 import random
-import pickle
-import matplotlib.image as mpl_image
 from cached_property import cached_property
 from ..types import Image, ConvexHull
+from ..decks.base import Deck
+from ..util import atomic_write, read_image, read_images
+from ..hull_manifest import HullManifest
+from .. import metrics
 
-ImageWithHulls = tuple[Image, list[ConvexHull]]
+# card name, image path, hulls
+CardImageEntry = tuple[str, str, list[ConvexHull]]
+# columns describing each source image: path relative to the source directory, size and
+# mtime, plus offset and shape within the packed cache once it's been written there
+BackgroundManifest = dict[str, np.ndarray]
+MANIFEST_COLUMNS = ("paths", "sizes", "mtimes")
 
+# legacy format: a pickled list of every image as decoded by matplotlib, so RGB (and for
+# JPEGs, corrupted); it can't be reused, so it's deleted once the packed cache is written
 CACHE_FILENAME = "image_source_cache.pickle"
+# every decoded BGR image back-to-back in one uint8 blob, memory-mapped so that processes
+# share a single copy through the page cache...
+PACKED_CACHE_FILENAME = "image_source_cache.bin"
+# ...and the offset and shape of each image within it, along with the manifest of source
+# files it was built from
+PACKED_INDEX_FILENAME = "image_source_cache.index.npz"
+# the same again with every image scaled so that its shorter side is the given number of
+# pixels, which scenes of up to that size can be cropped from without any resampling
+SCALED_CACHE_FILENAME = "image_source_cache.{}px.bin"
+SCALED_INDEX_FILENAME = "image_source_cache.{}px.index.npz"
+
+# every BGRA card image as one memory-mapped (n, deck.height, deck.width, 4) array...
+CARD_ATLAS_FILENAME = "card_atlas.npy"
+# ...and the columnar metadata for it (card names, source paths, hulls)
+CARD_ATLAS_INDEX_FILENAME = "card_atlas.index.npz"
 
 
 @dataclass
@@ -27,70 +55,530 @@ class BackgroundImageSource:
     _backgrounds: list[Image]
 
     @staticmethod
-    def from_disk(directory: str) -> BackgroundImageSource:
+    def from_disk(directory: str, min_size: int = 0) -> BackgroundImageSource:
+        """
+        With min_size, the backgrounds are scaled so that their shorter side is that many
+        pixels, once for every process that asks for the same size, so that
+        fill_with_random_crop never has to scale them itself.
+        """
+        manifest = BackgroundImageSource._scan_source_images(directory)
+
         try:
-            backgrounds = BackgroundImageSource._from_cache(directory)
-            print(f"loaded {len(backgrounds)} backgrounds from cache")
+            index = BackgroundImageSource._read_packed_index(directory)
         except FileNotFoundError:
-            backgrounds = BackgroundImageSource._from_source_images(directory)
-            print(f"loaded {len(backgrounds)} backgrounds")
-            BackgroundImageSource._write_cache(directory, backgrounds)
-            print("wrote background cache file to cache.pickle")
+            index = None
+
+        if index is not None and set(_manifest_keys(index)) == set(
+            _manifest_keys(manifest)
+        ):
+            print(f"loaded {len(index['paths'])} backgrounds from cache")
+        else:
+            index = BackgroundImageSource._update_packed_cache(
+                directory, manifest, index
+            )
+            print(
+                f"loaded {len(index['paths'])} backgrounds; wrote background cache file "
+                f"to {PACKED_CACHE_FILENAME}"
+            )
+
+        if min_size > 0:
+            index = BackgroundImageSource._update_scaled_cache(
+                directory, index, min_size
+            )
+        return BackgroundImageSource(
+            _backgrounds=BackgroundImageSource._from_packed_cache(
+                directory, index, min_size
+            )
+        )
 
-        return BackgroundImageSource(_backgrounds=backgrounds)
+    @staticmethod
+    def _scan_source_images(directory: str) -> BackgroundManifest:
+        # cache entries are keyed on path, size and mtime, which is enough to notice any
+        # file that has been added, removed or replaced without having to read them all
+        paths = glob(os.path.join(directory, "**/*.jpg"))
+        stats = [os.stat(p) for p in paths]
+        return {
+            "paths": np.array(
+                [os.path.relpath(p, directory) for p in paths], dtype=str
+            ),
+            "sizes": np.array([s.st_size for s in stats], dtype=np.int64),
+            "mtimes": np.array([s.st_mtime_ns for s in stats], dtype=np.int64),
+        }
+
+    @staticmethod
+    def _read_packed_index(directory: str, min_size: int = 0) -> BackgroundManifest:
+        blob_filename, index_filename = _packed_cache_filenames(min_size)
+        # an index without its blob is useless; treat it as missing
+        if not os.path.exists(os.path.join(directory, blob_filename)):
+            raise FileNotFoundError(blob_filename)
+        with np.load(os.path.join(directory, index_filename)) as f:
+            return {k: f[k] for k in f.files}
 
     @staticmethod
-    def _from_cache(directory: str) -> list[Image]:
-        with open(os.path.join(directory, CACHE_FILENAME), "rb") as f:
-            return pickle.load(f)
+    def _from_packed_cache(
+        directory: str, index: BackgroundManifest, min_size: int = 0
+    ) -> list[Image]:
+        if len(index["offsets"]) == 0:
+            return []
+
+        blob_filename, _ = _packed_cache_filenames(min_size)
+        blob = np.memmap(
+            os.path.join(directory, blob_filename), dtype=np.uint8, mode="r"
+        )
+        return [
+            blob[offset : offset + np.prod(shape)].reshape(shape)
+            for offset, shape in zip(index["offsets"], index["shapes"])
+        ]
 
     @staticmethod
-    def _from_source_images(directory: str) -> list[Image]:
-        backgrounds = []
-        for f in glob(os.path.join(directory, "**/*.jpg")):
-            backgrounds.append((mpl_image.imread(f) * 255).astype(np.uint8))
-        return backgrounds
+    def _update_packed_cache(
+        directory: str,
+        manifest: BackgroundManifest,
+        index: Optional[BackgroundManifest],
+        min_size: int = 0,
+        read_added: Optional[Callable[[BackgroundManifest], Iterable[Image]]] = None,
+    ) -> BackgroundManifest:
+        """
+        Bring the packed cache (or with min_size, the scaled one) in line with manifest,
+        reading only the images that are not already in it. By default they're decoded
+        from the source files; read_added supplies them instead, given their manifest.
+        """
+        cached_rows = (
+            {k: i for i, k in enumerate(_manifest_keys(index))} if index else {}
+        )
+        keys = _manifest_keys(manifest)
+        added = [i for i, k in enumerate(keys) if k not in cached_rows]
+        kept_rows = [cached_rows[k] for k in keys if k in cached_rows]
+        blob_filename, _ = _packed_cache_filenames(min_size)
+        print(
+            f"{blob_filename}: {len(kept_rows)} unchanged, {len(added)} added, "
+            f"{len(cached_rows) - len(kept_rows)} removed"
+        )
+
+        added_manifest = {k: manifest[k][added] for k in MANIFEST_COLUMNS}
+        if read_added is None:
+            # grayscale images get an explicit channel axis so every shape has the same
+            # length
+            added_backgrounds: Iterable[Image] = (
+                np.atleast_3d(b)
+                for b in read_images(
+                    [os.path.join(directory, p) for p in added_manifest["paths"]]
+                )
+            )
+        else:
+            added_backgrounds = read_added(added_manifest)
+
+        if index is None:
+            return BackgroundImageSource._write_packed_cache(
+                directory, added_manifest, added_backgrounds, min_size
+            )
+
+        kept_index = {k: v[kept_rows] for k, v in index.items()}
+        blob_path = os.path.join(directory, blob_filename)
+        blob_size = os.path.getsize(blob_path) if os.path.exists(blob_path) else 0
+        kept_size = int(np.prod(kept_index["shapes"], axis=1).sum())
+
+        if kept_size * 2 < blob_size:
+            # most of the blob is now dead space, so rewrite it from scratch
+            return BackgroundImageSource._write_packed_cache(
+                directory,
+                {
+                    k: np.concatenate((kept_index[k], added_manifest[k]))
+                    for k in MANIFEST_COLUMNS
+                },
+                itertools.chain(
+                    BackgroundImageSource._from_packed_cache(
+                        directory, kept_index, min_size
+                    ),
+                    added_backgrounds,
+                ),
+                min_size,
+            )
+
+        # otherwise append: the existing bytes don't move, so any process that already
+        # has the blob mapped is unaffected, and until the new index is in place nobody
+        # will look past the end of the old data
+        with open(blob_path, "ab") as f:
+            shapes = _write_backgrounds(f, added_backgrounds)
+        added_index = _pack_backgrounds(added_manifest, shapes, blob_size)
+        index = {k: np.concatenate((kept_index[k], added_index[k])) for k in index}
+        BackgroundImageSource._write_packed_index(directory, index, min_size)
+        return index
 
     @staticmethod
-    def _write_cache(directory: str, backgrounds: list[Image]):
-        with open(os.path.join(directory, CACHE_FILENAME), "wb") as f:
-            pickle.dump(backgrounds, f)
+    def _update_scaled_cache(
+        directory: str, index: BackgroundManifest, min_size: int
+    ) -> BackgroundManifest:
+        """
+        Bring the scaled cache for min_size in line with the packed cache's index,
+        scaling only the images that are not already in it.
+        """
+        try:
+            scaled_index: Optional[BackgroundManifest] = (
+                BackgroundImageSource._read_packed_index(directory, min_size)
+            )
+        except FileNotFoundError:
+            scaled_index = None
+        if scaled_index is not None and set(_manifest_keys(scaled_index)) == set(
+            _manifest_keys(index)
+        ):
+            return scaled_index
+
+        # scaled straight out of the memory-mapped originals as they're written, so only
+        # one scaled image is ever in memory at a time
+        originals = BackgroundImageSource._from_packed_cache(directory, index)
+        rows = {k: i for i, k in enumerate(_manifest_keys(index))}
+        return BackgroundImageSource._update_packed_cache(
+            directory,
+            index,
+            scaled_index,
+            min_size,
+            lambda added: (
+                _scale_to_min_size(originals[rows[k]], min_size)
+                for k in _manifest_keys(added)
+            ),
+        )
+
+    @staticmethod
+    def _write_packed_cache(
+        directory: str,
+        manifest: BackgroundManifest,
+        backgrounds: Iterable[Image],
+        min_size: int = 0,
+    ) -> BackgroundManifest:
+        blob_filename, _ = _packed_cache_filenames(min_size)
+        with atomic_write(os.path.join(directory, blob_filename)) as f:
+            shapes = _write_backgrounds(f, backgrounds)
+        index = _pack_backgrounds(manifest, shapes, 0)
+        BackgroundImageSource._write_packed_index(directory, index, min_size)
+        if min_size == 0 and os.path.exists(os.path.join(directory, CACHE_FILENAME)):
+            os.remove(os.path.join(directory, CACHE_FILENAME))
+            print(f"removed legacy background cache {CACHE_FILENAME}")
+        return index
+
+    @staticmethod
+    def _write_packed_index(
+        directory: str, index: BackgroundManifest, min_size: int = 0
+    ):
+        # always written after the blob, so if it exists the blob is complete
+        _, index_filename = _packed_cache_filenames(min_size)
+        with atomic_write(os.path.join(directory, index_filename)) as f:
+            np.savez(f, **index)
 
     def get_random_background(self) -> Image:
         return random.choice(self._backgrounds)
 
+    def fill_with_random_crop(self, image: Image):
+        """
+        Fill the (height, width, 3) image with a window onto a random background, in a
+        random one of its eight orientations (turned through a multiple of 90 degrees,
+        and mirrored or not). Backgrounds too small for that are scaled up first; load
+        with from_disk's min_size to have that done once up front.
+        """
+        height, width = image.shape[:2]
+        background = random.choice(self._backgrounds)
+        size = max(width, height)
+        if min(background.shape[:2]) < size:
+            background = _scale_to_min_size(background, size)
+
+        # the window is only ever a slice of the background; it's turned while it's
+        # copied, since copying a numpy view that's been turned is many times slower
+        transpose = random.random() < 0.5
+        flip = random.choice((None, 0, 1, -1))
+        window_height, window_width = (width, height) if transpose else (height, width)
+        y = random.randint(0, background.shape[0] - window_height)
+        x = random.randint(0, background.shape[1] - window_width)
+        window = background[y : y + window_height, x : x + window_width]
+        if window.shape[2] == 1:
+            window = cv2.cvtColor(window, cv2.COLOR_GRAY2RGB)
+
+        if flip is None and not transpose:
+            image[:] = window
+        elif flip is None:
+            cv2.transpose(window, dst=image)
+        elif not transpose:
+            cv2.flip(window, flip, dst=image)
+        elif flip == 1:
+            cv2.rotate(window, cv2.ROTATE_90_CLOCKWISE, dst=image)
+        elif flip == 0:
+            cv2.rotate(window, cv2.ROTATE_90_COUNTERCLOCKWISE, dst=image)
+        else:
+            cv2.flip(cv2.transpose(window), -1, dst=image)
+
+
+def _scale_to_min_size(image: Image, min_size: int) -> Image:
+    height, width = image.shape[:2]
+    factor = min_size / min(height, width)
+    size = (
+        max(min_size, round(width * factor)),
+        max(min_size, round(height * factor)),
+    )
+    interpolation = cv2.INTER_AREA if factor < 1 else cv2.INTER_CUBIC
+    # resize drops the channel axis of grayscale images, so put it back
+    return np.atleast_3d(cv2.resize(image, size, interpolation=interpolation))
+
+
+def _packed_cache_filenames(min_size: int) -> tuple[str, str]:
+    if min_size == 0:
+        return PACKED_CACHE_FILENAME, PACKED_INDEX_FILENAME
+    return SCALED_CACHE_FILENAME.format(min_size), SCALED_INDEX_FILENAME.format(
+        min_size
+    )
+
+
+def _manifest_keys(manifest: BackgroundManifest) -> list[tuple[str, int, int]]:
+    return list(
+        zip(
+            manifest["paths"].tolist(),
+            manifest["sizes"].tolist(),
+            manifest["mtimes"].tolist(),
+        )
+    )
+
+
+def _pack_backgrounds(
+    manifest: BackgroundManifest, shapes: list[tuple[int, ...]], start_offset: int
+) -> BackgroundManifest:
+    shape_rows = np.array(shapes, dtype=np.int64).reshape(-1, 3)
+    sizes = np.prod(shape_rows, axis=1)
+    offsets = start_offset + np.cumsum(sizes) - sizes
+    return {**manifest, "offsets": offsets, "shapes": shape_rows}
+
+
+def _write_backgrounds(f: IO, backgrounds: Iterable[Image]) -> list[tuple[int, ...]]:
+    # streamed, so that only one image need be in memory at a time; returns their shapes
+    shapes = []
+    for b in backgrounds:
+        b = np.ascontiguousarray(np.atleast_3d(b), dtype=np.uint8)
+        f.write(b.data)
+        shapes.append(b.shape)
+    return shapes
+
+
+@dataclass
+class CardImageCache:
+    """
+    Card images decoded on first use and kept in least recently used order, evicting the
+    oldest once they take up more than max_bytes (though never the newest, however big).
+    """
+
+    paths: np.ndarray
+    max_bytes: int
+    hits: int = 0
+    misses: int = 0
+    _images: OrderedDict[int, Image] = field(default_factory=OrderedDict)
+    _bytes: int = 0
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __getitem__(self, index: int) -> Image:
+        image = self._images.get(index)
+        if image is not None:
+            self.hits += 1
+            metrics.count("cards.cache_hits")
+            self._images.move_to_end(index)
+            return image
+
+        self.misses += 1
+        metrics.count("cards.cache_misses")
+        image = read_image(self.paths[index])
+        self._images[index] = image
+        self._bytes += image.nbytes
+        while self._bytes > self.max_bytes and len(self._images) > 1:
+            _, evicted = self._images.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            metrics.count("cards.cache_evictions")
+        metrics.gauge_max("cards_cache_peak_bytes", self._bytes)
+        return image
+
 
 @dataclass
 class CardImageSource:
-    _cards: dict[str, list[ImageWithHulls]]
+    # (n, height, width, 4); memory-mapped when loaded from the atlas, or decoded on demand
+    # when loaded lazily
+    _images: Union[np.ndarray, CardImageCache]
+    _card_names: list[str]
+    # the remaining fields are a columnar index with one entry per image...
+    _image_card_ids: np.ndarray
+    _image_paths: np.ndarray
+    # ...where image i has hulls _image_hull_offsets[i] up to _image_hull_offsets[i + 1]...
+    _image_hull_offsets: np.ndarray
+    # ...and hull h has points _hull_offsets[h] up to _hull_offsets[h + 1]
+    _hull_offsets: np.ndarray
+    _hull_points: np.ndarray
 
     @staticmethod
-    def from_disk(directory: str) -> CardImageSource:
-        cards: dict[str, list[ImageWithHulls]] = {}
-        for card_dir in glob(os.path.join(directory, "*")):
-            card_name = os.path.basename(card_dir)
-            cards[card_name] = []
-            # all pickles should have images, but nto vice versa, so start with them
-            for pickle_file in glob(os.path.join(card_dir, "*.pickle")):
-                image_file = os.path.splitext(pickle_file)[0] + ".png"
-                if not os.path.exists(image_file):
-                    print(f"no corresponding image file for pickle {pickle_file}")
-                    continue
-                with open(pickle_file, "rb") as f:
-                    hulls = pickle.load(f)
-                cards[card_name].append(
-                    ((mpl_image.imread(image_file) * 255).astype(np.uint8), hulls)
+    def from_disk(directory: str, cache_bytes: int = 0) -> CardImageSource:
+        """
+        With cache_bytes, only the hulls are loaded up front when there's no atlas; the
+        images are decoded as they're drawn and cached up to that many bytes. (An atlas
+        is always preferred: it's memory-mapped, so it's already loaded lazily, and its
+        pages are shared between processes and can be reclaimed.)
+        """
+        try:
+            source = CardImageSource._from_atlas(directory)
+            print(f"loaded {len(source)} card images from atlas")
+        except FileNotFoundError:
+            entries = CardImageSource._scan_directory(directory)
+            if not entries:
+                print(
+                    f"no card images with hulls in {directory}; "
+                    "run find-convex-hulls first"
                 )
+                return CardImageSource._from_index(
+                    np.empty((0, 0, 0, 4), dtype=np.uint8),
+                    CardImageSource._build_index(entries),
+                )
+            if cache_bytes > 0:
+                index = CardImageSource._build_index(entries)
+                source = CardImageSource._from_index(
+                    CardImageCache(paths=index["image_paths"], max_bytes=cache_bytes),
+                    index,
+                )
+                print(
+                    f"indexed {len(source)} card images, to be loaded into a "
+                    f"{cache_bytes / 2**20:.0f}MB cache as they're used"
+                )
+                return source
+            source = CardImageSource._from_index(
+                np.stack(list(read_images([path for _, path, _ in entries]))),
+                CardImageSource._build_index(entries),
+            )
+            print(f"loaded {len(source)} card images")
+        return source
 
-        return CardImageSource(_cards=cards)
+    @staticmethod
+    def write_atlas(directory: str, deck: Deck) -> int:
+        """
+        Pack every card image that has hulls into an atlas that from_disk will prefer over
+        the individual files. Returns the number of images packed.
+        """
+        entries = CardImageSource._scan_directory(directory)
+        shape = (len(entries), deck.height, deck.width, 4)
+
+        # stream the images straight into the .npy so they're never all in memory at once
+        with atomic_write(os.path.join(directory, CARD_ATLAS_FILENAME)) as f:
+            np.lib.format.write_array_header_1_0(
+                f,
+                {
+                    "descr": np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+                    "fortran_order": False,
+                    "shape": shape,
+                },
+            )
+            for (_, path, _), image in zip(
+                entries, read_images([path for _, path, _ in entries])
+            ):
+                if image.shape != shape[1:]:
+                    raise ValueError(
+                        f"expected {path} to have shape {shape[1:]}, got {image.shape}"
+                    )
+                f.write(image.data)
+
+        with atomic_write(os.path.join(directory, CARD_ATLAS_INDEX_FILENAME)) as f:
+            np.savez(f, **CardImageSource._build_index(entries))
+
+        return len(entries)
+
+    @staticmethod
+    def remove_atlas(directory: str) -> bool:
+        removed = False
+        for filename in (CARD_ATLAS_INDEX_FILENAME, CARD_ATLAS_FILENAME):
+            try:
+                os.remove(os.path.join(directory, filename))
+                removed = True
+            except FileNotFoundError:
+                pass
+        return removed
+
+    @staticmethod
+    def _from_atlas(directory: str) -> CardImageSource:
+        # the index is written last, so if it exists the atlas is complete
+        with np.load(os.path.join(directory, CARD_ATLAS_INDEX_FILENAME)) as f:
+            index = {k: f[k] for k in f.files}
+        images = np.load(os.path.join(directory, CARD_ATLAS_FILENAME), mmap_mode="r")
+        return CardImageSource._from_index(images, index)
+
+    @staticmethod
+    def _from_index(
+        images: Union[np.ndarray, CardImageCache], index: dict
+    ) -> CardImageSource:
+        assert len(images) == len(index["image_card_ids"])
+        return CardImageSource(
+            _images=images,
+            _card_names=[str(n) for n in index["card_names"]],
+            _image_card_ids=index["image_card_ids"],
+            _image_paths=index["image_paths"],
+            _image_hull_offsets=index["image_hull_offsets"],
+            _hull_offsets=index["hull_offsets"],
+            _hull_points=index["hull_points"],
+        )
+
+    @staticmethod
+    def _scan_directory(directory: str) -> list[CardImageEntry]:
+        manifest = HullManifest.load(directory)
+        entries = []
+        for entry in sorted(manifest.entries.values(), key=lambda e: e.image_path):
+            if entry.hulls is None:
+                continue
+            image_file = os.path.join(directory, entry.image_path)
+            if not os.path.exists(image_file):
+                print(f"no image file for manifest entry {entry.image_path}")
+                continue
+            entries.append((entry.card_name, image_file, entry.hulls))
+        return entries
+
+    @staticmethod
+    def _build_index(entries: list[CardImageEntry]) -> dict:
+        card_names = sorted({name for name, _, _ in entries})
+        card_ids = {name: i for i, name in enumerate(card_names)}
+        hulls = [h.reshape(-1, 2) for _, _, image_hulls in entries for h in image_hulls]
+        return {
+            "card_names": np.array(card_names, dtype=str),
+            "image_card_ids": np.array(
+                [card_ids[name] for name, _, _ in entries], dtype=np.int32
+            ),
+            "image_paths": np.array([path for _, path, _ in entries], dtype=str),
+            "image_hull_offsets": np.cumsum(
+                [0] + [len(image_hulls) for _, _, image_hulls in entries],
+                dtype=np.int64,
+            ),
+            "hull_offsets": np.cumsum([0] + [len(h) for h in hulls], dtype=np.int64),
+            "hull_points": (
+                np.concatenate(hulls).astype(np.int32)
+                if hulls
+                else np.zeros((0, 2), dtype=np.int32)
+            ),
+        }
+
+    def __len__(self) -> int:
+        return len(self._image_card_ids)
 
     @cached_property
-    def _card_names(self) -> list[str]:
-        return list(self._cards)
+    def _image_ids_by_card(self) -> list[np.ndarray]:
+        return [
+            np.flatnonzero(self._image_card_ids == i)
+            for i in range(len(self._card_names))
+        ]
+
+    def get_card(self, index: int) -> CardWithMetadata:
+        hulls = [
+            self._hull_points[
+                self._hull_offsets[h] : self._hull_offsets[h + 1]
+            ].reshape(-1, 1, 2)
+            for h in range(
+                self._image_hull_offsets[index], self._image_hull_offsets[index + 1]
+            )
+        ]
+        return CardWithMetadata(
+            name=self._card_names[self._image_card_ids[index]],
+            image=self._images[index],
+            hulls=hulls,
+        )
 
     def get_random_cards(self, n: int) -> list[CardWithMetadata]:
-        cards = []
-        for c in random.sample(self._card_names, n):
-            image, hulls = random.choice(self._cards[c])
-            cards.append(CardWithMetadata(name=c, image=image, hulls=hulls))
-        return cards
+        return [
+            self.get_card(random.choice(self._image_ids_by_card[c]))
+            for c in random.sample(range(len(self._card_names)), n)
+        ]
@@ -0,0 +1,52 @@
+from typing import Union
+import numpy as np
+
+# 3x3 homogeneous affine transforms in pixel space (x right, y down). Compose with `@`;
+# the rightmost transform is applied first.
+#
+# Every constructor also accepts arrays of parameters, in which case it returns a stack of
+# transforms with shape (*parameters.shape, 3, 3), which compose elementwise with `@`.
+Transform = np.ndarray
+Parameter = Union[float, np.ndarray]
+
+
+def _identity(*parameters: Parameter) -> Transform:
+    shape = np.broadcast(*parameters).shape
+    return np.broadcast_to(np.eye(3), (*shape, 3, 3)).copy()
+
+
+def translate(dx: Parameter, dy: Parameter) -> Transform:
+    transform = _identity(dx, dy)
+    transform[..., 0, 2] = dx
+    transform[..., 1, 2] = dy
+    return transform
+
+
+def rotate(degrees: Parameter, *, cx: Parameter = 0, cy: Parameter = 0) -> Transform:
+    # same convention as imgaug's Affine: positive degrees rotate clockwise on screen
+    radians = np.radians(degrees)
+    cos, sin = np.cos(radians), np.sin(radians)
+    rotation = _identity(degrees)
+    rotation[..., 0, 0] = cos
+    rotation[..., 0, 1] = -sin
+    rotation[..., 1, 0] = sin
+    rotation[..., 1, 1] = cos
+    return translate(cx, cy) @ rotation @ translate(np.negative(cx), np.negative(cy))
+
+
+def scale(factor: Parameter, *, cx: Parameter = 0, cy: Parameter = 0) -> Transform:
+    scaling = _identity(factor)
+    scaling[..., 0, 0] = factor
+    scaling[..., 1, 1] = factor
+    return translate(cx, cy) @ scaling @ translate(np.negative(cx), np.negative(cy))
+
+
+def transform_points(transform: Transform, points: np.ndarray) -> np.ndarray:
+    """
+    Apply transform to an (n, 2) array of x, y points, or a stack of transforms to a
+    matching stack of (n, 2) arrays.
+    """
+    return (
+        points @ np.swapaxes(transform[..., :2, :2], -1, -2)
+        + transform[..., None, :2, 2]
+    )
@@ -1,7 +1,20 @@
-from typing import Tuple, Optional
+from __future__ import annotations
+
+from typing import Tuple, Optional, IO, Iterator, Sequence
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
 import cv2
 from .types import Image
 
+# mkstemp creates files readable only by their owner, so atomic_write gives them the mode
+# a plain open() would have; reading the umask means setting it, so do that just once
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 
 def show_images_in_windows(*images: Tuple[str, Optional[Image]]):
     did_show = False
@@ -15,3 +28,88 @@ def show_images_in_windows(*images: Tuple[str, Optional[Image]]):
         cv2.waitKey(0)
         cv2.destroyAllWindows()
         cv2.waitKey(1)
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "wb") -> Iterator[IO]:
+    """
+    Open path for writing such that readers only ever see the previous or the complete new
+    file: write to a temporary file alongside it and rename it into place on success.
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=f"{os.path.basename(path)}."
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(temp_path, 0o666 & ~_UMASK)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def read_images(
+    paths: Sequence[str], threads: Optional[int] = None, max_pending: int = 64
+) -> Iterator[Image]:
+    """
+    Decode images on a pool of threads, yielding them in the order of paths. Like
+    cv2.imwrite, cv2.imread releases the GIL, so decoding scales with cores. Images come
+    back as uint8 with their channels in OpenCV's BGR(A) order; grayscale images have no
+    channel axis. At most max_pending decoded images are held at once.
+    """
+    with ThreadPoolExecutor(threads or os.cpu_count()) as executor:
+        pending: deque[Future] = deque()
+        for path in paths:
+            pending.append(executor.submit(read_image, path))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_image(path: str) -> Image:
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise IOError(f"could not read image from {path}")
+    return image
+
+
+class AsyncImageWriter:
+    """
+    Encode and write images on a pool of threads while the caller carries on producing
+    them. cv2.imwrite releases the GIL, so encoding genuinely overlaps with decoding. At most
+    max_pending images are held at once: write() blocks when the writers fall behind.
+
+    Use as a context manager; leaving it waits for every write and re-raises the first
+    error, if any.
+    """
+
+    def __init__(self, threads: int = 4, max_pending: int = 16):
+        self._executor = ThreadPoolExecutor(threads)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._errors: list[BaseException] = []
+
+    def write(self, path: str, image: Image):
+        if self._errors:
+            raise self._errors[0]
+        self._slots.acquire()
+        self._executor.submit(self._write, path, image).add_done_callback(self._on_done)
+
+    @staticmethod
+    def _write(path: str, image: Image):
+        if not cv2.imwrite(path, image):
+            raise IOError(f"could not write image to {path}")
+
+    def _on_done(self, future: Future):
+        self._slots.release()
+        if (error := future.exception()) is not None:
+            self._errors.append(error)
+
+    def __enter__(self) -> AsyncImageWriter:
+        return self
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown(wait=True)
+        if self._errors and exc_info[0] is None:
+            raise self._errors[0]
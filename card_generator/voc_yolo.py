@@ -0,0 +1,64 @@
+import os
+import xml.etree.ElementTree as ET
+
+
+def read_class_names(path: str) -> list[str]:
+    with open(path) as f:
+        return [line for line in f.read().split("\n") if line != ""]
+
+
+def _find_text(element: ET.Element, path: str, xml_path: str) -> str:
+    text = element.findtext(path)
+    if text is None:
+        raise ValueError(f"{xml_path} has no {path}")
+    return text
+
+
+def convert_voc_annotation(xml_path: str, class_ids: dict[str, int]) -> str:
+    """
+    The YOLO labels for a Pascal VOC annotation: one "class x_center y_center width height"
+    line per object, relative to the image size. Difficult objects and objects of classes
+    not in class_ids are left out.
+    """
+    root = ET.parse(xml_path).getroot()
+    width = int(_find_text(root, "size/width", xml_path))
+    height = int(_find_text(root, "size/height", xml_path))
+
+    lines = []
+    for obj in root.iter("object"):
+        class_id = class_ids.get(_find_text(obj, "name", xml_path))
+        if class_id is None or int(_find_text(obj, "difficult", xml_path)) == 1:
+            continue
+        x1, x2, y1, y2 = (
+            float(_find_text(obj, f"bndbox/{tag}", xml_path))
+            for tag in ("xmin", "xmax", "ymin", "ymax")
+        )
+        # same arithmetic as the old convert_voc_yolo.py script, so that reconverting an
+        # existing dataset gives identical labels
+        dw, dh = 1.0 / width, 1.0 / height
+        lines.append(
+            f"{class_id} {(x1 + x2) / 2.0 * dw:0.6f} {(y1 + y2) / 2.0 * dh:0.6f} "
+            f"{(x2 - x1) * dw:0.6f} {(y2 - y1) * dh:0.6f}\n"
+        )
+    return "".join(lines)
+
+
+def convert_voc_annotation_file(
+    xml_path: str, class_ids: dict[str, int], classes_mtime: float = 0
+) -> bool:
+    """
+    Write the YOLO labels for xml_path next to it, unless they're already newer than both
+    it and classes_mtime, the time the class names were last changed. Returns whether they
+    were written.
+    """
+    txt_path = os.path.splitext(xml_path)[0] + ".txt"
+    try:
+        if os.path.getmtime(txt_path) >= max(os.path.getmtime(xml_path), classes_mtime):
+            return False
+    except FileNotFoundError:
+        pass
+
+    labels = convert_voc_annotation(xml_path, class_ids)
+    with open(txt_path, "w") as f:
+        f.write(labels)
+    return True
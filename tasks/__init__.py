@@ -1,28 +1,44 @@
-from invoke import Collection
+from typing import Counter, Optional
+from invoke import Collection, Exit
 from glob import glob
 import matplotlib.image as mpimage
-import pickle
 import os
 import cv2
 import shutil
 import random
+import traceback
+import hashlib
+from tqdm import tqdm
 from card_generator.extract_card import (
-    extract_cards_from_video,
+    iter_cards_from_video,
     VideoExtractionParameters,
+    REJECTION_STAGES,
 )
-from card_generator.find_convex_hull import (
-    find as find_convex_hull_impl,
-    FindParameters as FindConvexHullParameters,
-)
+from card_generator.perceptual_hash import perceptual_hash, PerceptualHashIndex
+from card_generator.find_convex_hull import find_all, get_find_parameters, FindAllResult
+from card_generator.hull_manifest import HullManifest, HullManifestEntry
+from card_generator.voc_yolo import read_class_names, convert_voc_annotation_file
 from card_generator.decks.base import Deck, CardGroup
-from card_generator.util import show_images_in_windows
-from .util import augment_with_task_decorator, get_deck_by_name
-from tasks import test
+from card_generator.dataset import (
+    DatasetParameters,
+    generate_dataset as generate_dataset_impl,
+)
+from card_generator.scenes.image_source import CardImageSource
+from card_generator.util import show_images_in_windows, AsyncImageWriter
+from .util import (
+    augment_with_task_decorator,
+    get_deck_by_name,
+    map_unordered,
+    metrics_output,
+)
+from tasks import test, bench
 
 DATA_DIR = "data"
+HULL_MANIFEST_SAVE_INTERVAL = 1000
 
 ns = augment_with_task_decorator(Collection())
 ns.add_collection(Collection.from_module(test))
+ns.add_collection(Collection.from_module(bench))
 task = ns.task
 
 
@@ -39,86 +55,332 @@ def fetch_backgrounds(c):
     print("done")
 
 
+def _next_image_number(directory: str) -> int:
+    numbers = [
+        int(stem)
+        for stem, ext in map(os.path.splitext, os.listdir(directory))
+        if ext == ".png" and stem.isdigit()
+    ]
+    return max(numbers, default=-1) + 1
+
+
+def _extract_from_video(
+    args: tuple[str, str, str, VideoExtractionParameters, int, bool]
+) -> tuple[str, int, int, Counter[str], Optional[str]]:
+    card, video_path, output_path, parameters, dedupe_distance, parallel = args
+
+    if parallel:
+        # the pool already has a process per core; don't let OpenCV oversubscribe them
+        cv2.setNumThreads(1)
+
+    rejections: Counter[str] = Counter()
+    try:
+        os.makedirs(output_path, exist_ok=True)
+        # images from earlier runs are kept, so dedupe against them and number after
+        # them
+        hashes = PerceptualHashIndex.load(output_path, dedupe_distance)
+        first = n = _next_image_number(output_path)
+        duplicates = 0
+        with AsyncImageWriter() as writer:
+            for image in iter_cards_from_video(
+                # reusing parameters here is a little risky, but we shouldn't be mutating it!
+                cv2.VideoCapture(video_path),
+                parameters,
+                # interleaved progress bars from several processes are unreadable
+                show_progress=not parallel,
+                rejections=rejections,
+            ):
+                image_hash = perceptual_hash(image)
+                if hashes.find_duplicate(image_hash) is not None:
+                    duplicates += 1
+                    continue
+                writer.write(os.path.join(output_path, f"{n}.png"), image)
+                hashes.add(f"{n}.png", image_hash)
+                n += 1
+        hashes.save(output_path)
+
+        return card, n - first, duplicates, rejections, None
+    except Exception:
+        # report rather than raise, so that one bad video doesn't abort all the others
+        return card, 0, 0, rejections, traceback.format_exc()
+
+
 @task
 def extract_from_videos(
-    c, deck_module_name, extension="mov", indir="data/video", outdir="data/cards"
+    c,
+    deck_module_name,
+    extension="mov",
+    indir="data/video",
+    outdir="data/cards",
+    jobs=1,
+    keep_existing=False,
+    dedupe_distance=4,
+    metrics=None,
 ):
-    shutil.rmtree(outdir, ignore_errors=True)
+    """
+    Pass --keep-existing to add to previously-extracted images rather than replacing them.
+    Images whose perceptual hashes are within --dedupe-distance bits of an image already
+    extracted for the same card are dropped; pass -1 to keep everything.
+    """
+    if not keep_existing:
+        shutil.rmtree(outdir, ignore_errors=True)
     os.makedirs(outdir, exist_ok=True)
 
-    deck = get_deck_by_name(deck_module_name)
+    with metrics_output(metrics):
+        deck = get_deck_by_name(deck_module_name)
+
+        parameters = VideoExtractionParameters(
+            card_width=deck.width, card_height=deck.height
+        )
+
+        work = []
+        for group in deck.cards:
+            for c in group.card_names:
+                video_path = os.path.join(indir, f"{c}.{extension}")
+                if not os.path.exists(video_path):
+                    print(f"could not find video for card {c} at {video_path}")
+                    continue
+
+                work.append(
+                    (
+                        c,
+                        video_path,
+                        os.path.join(outdir, c),
+                        parameters,
+                        dedupe_distance,
+                        jobs != 1,
+                    )
+                )
+
+        failures = []
+        for card, n, duplicates, rejections, error in map_unordered(
+            _extract_from_video, work, jobs
+        ):
+            if error is None:
+                print(
+                    f"extracted {n} images for card {card}; dropped {duplicates} "
+                    "near-duplicates; rejected frames by stage: "
+                    + ", ".join(
+                        f"{stage} {rejections[stage]}" for stage in REJECTION_STAGES
+                    )
+                )
+            else:
+                print(f"failed to extract images for card {card}:\n{error}")
+                failures.append(card)
+
+        if failures:
+            raise Exit(
+                f"failed to extract images for {len(failures)} card(s): {failures}"
+            )
 
-    parameters = VideoExtractionParameters(
-        card_width=deck.width, card_height=deck.height
+
+def _find_convex_hulls_for_image(
+    args: tuple[str, CardGroup]
+) -> tuple[str, FindAllResult]:
+    card_image_path, group = args
+    return card_image_path, find_all(
+        cv2.imread(card_image_path, cv2.IMREAD_UNCHANGED), group
     )
 
-    for group in deck.cards:
-        for c in group.card_names:
-            video_path = os.path.join(indir, f"{c}.{extension}")
-            if not os.path.exists(video_path):
-                print(f"could not find video for card {c} at {video_path}")
-                continue
 
-            result = extract_cards_from_video(
-                # reusing parameters here is a little risky, but we shouldn't be mutating it!
-                cv2.VideoCapture(video_path),
-                parameters,
+@task
+def find_convex_hulls(
+    c, deck_module_name, directory="data/cards", jobs=0, metrics=None
+):
+    """
+    Only images that are new or changed since the last run are processed, unless the
+    deck's rect definitions (or the hull-finding parameters) have changed.
+    """
+    with metrics_output(metrics):
+        deck = get_deck_by_name(deck_module_name)
+
+        manifest = HullManifest.load(directory)
+        # anything no longer on disk (or no longer in the deck) is dropped from the
+        # manifest
+        entries: dict[str, HullManifestEntry] = {}
+        fingerprints: dict[str, str] = {}
+        work = []
+
+        for group in deck.cards:
+            parameters = repr(get_find_parameters(group, deck.width, deck.height))
+            # changing any parameter invalidates every hull found with the old ones
+            fingerprint = hashlib.sha1(parameters.encode()).hexdigest()
+
+            for card in group.card_names:
+                card_path = os.path.join(directory, card)
+                if not os.path.exists(card_path):
+                    print(f"could not find images for card {card} at {card_path}")
+                    continue
+
+                for card_image_path in glob(os.path.join(card_path, "*.png")):
+                    image_path = os.path.relpath(card_image_path, directory)
+                    mtime = os.path.getmtime(card_image_path)
+                    entry = manifest.entries.get(image_path)
+                    if (
+                        entry is not None
+                        and entry.image_mtime == mtime
+                        and entry.fingerprint == fingerprint
+                    ):
+                        entries[image_path] = entry
+                    else:
+                        work.append((card_image_path, group))
+                    fingerprints[image_path] = fingerprint
+                    manifest.parameters[fingerprint] = parameters
+
+        # the atlas would still serve the images of any dropped entries
+        dropped = len(manifest.entries.keys() - entries.keys() - fingerprints.keys())
+        manifest.entries = entries
+        manifest.parameters = {
+            f: manifest.parameters[f] for f in set(fingerprints.values())
+        }
+
+        print(f"finding hulls for {len(work)} new or changed images")
+        for i, (card_image_path, result) in enumerate(
+            tqdm(
+                map_unordered(_find_convex_hulls_for_image, work, jobs, chunk_size=16),
+                total=len(work),
             )
+        ):
+            image_path = os.path.relpath(card_image_path, directory)
+            if not result.all_found:
+                print(
+                    f"could not find all hulls for {card_image_path} "
+                    f"({result.rejections}); skipping"
+                )
+            manifest.entries[image_path] = HullManifestEntry(
+                card_name=os.path.basename(os.path.dirname(card_image_path)),
+                image_path=image_path,
+                image_mtime=os.path.getmtime(card_image_path),
+                fingerprint=fingerprints[image_path],
+                hulls=result.hulls if result.all_found else None,
+            )
+            # save every so often, so that an interrupted run can resume
+            if (i + 1) % HULL_MANIFEST_SAVE_INTERVAL == 0:
+                manifest.save(directory)
 
-            output_path = os.path.join(outdir, c)
-            os.makedirs(output_path)
-            for i, image in enumerate(result):
-                cv2.imwrite(os.path.join(output_path, f"{i}.png"), image)
+        manifest.save(directory)
 
-            print(f"extracted {len(result)} images for card {c}")
+        # superseded by the manifest: per-image pickles and per-card state from older
+        # runs
+        stale_files = glob(os.path.join(directory, "*", "*.pickle")) + glob(
+            os.path.join(directory, "*", "hulls.json")
+        )
+        for stale_file in stale_files:
+            os.remove(stale_file)
+        if stale_files:
+            print(f"removed {len(stale_files)} files superseded by the hull manifest")
+
+        totals: Counter[str] = Counter()
+        successes: Counter[str] = Counter()
+        for entry in manifest.entries.values():
+            totals[entry.card_name] += 1
+            successes[entry.card_name] += entry.hulls is not None
+        for card in sorted(totals):
+            print(f"used {successes[card]}/{totals[card]} images for {card}")
+
+        if (work or dropped) and CardImageSource.remove_atlas(directory):
+            print("removed stale card atlas; rerun pack-cards to rebuild it")
 
 
 @task
-def find_convex_hulls(c, deck_module_name, directory="data/cards"):
+def pack_cards(c, deck_module_name, directory="data/cards"):
     deck = get_deck_by_name(deck_module_name)
+    n = CardImageSource.write_atlas(directory, deck)
+    print(f"packed {n} card images into an atlas in {directory}")
 
-    for group in deck.cards:
-        # sorting is best-effort so that chunks of work are logged in order, though the
-        # ordering of CardGroups is not consistent across invocations (they don't sort well)
-        for card in sorted(group.card_names):
-            card_path = os.path.join(directory, card)
-            if not os.path.exists(card_path):
-                print(f"could not find images for card {card} at {card_path}")
-                continue
-
-            for pickle_path in glob(os.path.join(card_path, "*.pickle")):
-                os.remove(pickle_path)
-
-            total = 0
-            successes = 0
-
-            for card_image_path in glob(os.path.join(card_path, "*.png")):
-                total += 1
-                image = cv2.imread(card_image_path, cv2.IMREAD_UNCHANGED)
-                hulls = []
-                for r in group.identifiable_rects:
-                    parameters = FindConvexHullParameters(
-                        rect=r.as_nparray(
-                            card_width=deck.width, card_height=deck.height
-                        ),
-                        hull_area_range=r.hull_area_range,
-                    )
-                    hull, _ = find_convex_hull_impl(image, parameters)
-                    if hull is None:
-                        hulls = []
-                        break
-                    else:
-                        hulls.append(hull)
-                if not hulls:
-                    print(f"could not find all hulls for {card_image_path}; skipping")
-                else:
-                    successes += 1
-                    with open(
-                        os.path.splitext(card_image_path)[0] + ".pickle", "wb"
-                    ) as f:
-                        pickle.dump(hulls, f)
-
-            print(f"used {successes}/{total} images for {card}")
+
+@task
+def generate_dataset(
+    c,
+    deck_module_name,
+    n_scenes=1000,
+    cards_per_scene=3,
+    outdir="data/scenes",
+    backgrounds_dir="data/backgrounds",
+    cards_dir="data/cards",
+    width=1000,
+    height=1000,
+    seed=0,
+    jobs=0,
+    yolo=True,
+    voc=False,
+    shard_size=0,
+    card_cache_mb=0,
+    metrics=None,
+):
+    """
+    Labels are written as YOLO txt files and/or VOC xml files next to each image, or
+    with --shard-size, packed together with the images into tars of that many scenes.
+    Without a card atlas, --card-cache-mb caps the memory each worker spends on card
+    images, which are then decoded as they're drawn.
+    """
+    with metrics_output(metrics):
+        deck = get_deck_by_name(deck_module_name)
+
+        parameters = DatasetParameters(
+            deck=deck,
+            backgrounds_dir=backgrounds_dir,
+            cards_dir=cards_dir,
+            outdir=outdir,
+            width=width,
+            height=height,
+            cards_per_scene=cards_per_scene,
+            seed=seed,
+            yolo_labels=yolo,
+            voc_labels=voc,
+            shard_size=shard_size,
+            card_cache_bytes=int(card_cache_mb) * 2**20,
+        )
+
+        total_boxes = 0
+        for n_boxes in tqdm(
+            generate_dataset_impl(parameters, n_scenes, jobs=jobs or os.cpu_count()),
+            total=n_scenes,
+        ):
+            total_boxes += n_boxes
+
+        print(
+            f"generated {n_scenes} scenes with {total_boxes} bounding boxes in {outdir}"
+        )
+
+
+def _convert_voc_annotation(args: tuple[str, dict[str, int], float]) -> bool:
+    return convert_voc_annotation_file(*args)
+
+
+@task
+def convert_voc_yolo(c, images_dir, classes_file, list_file, jobs=0):
+    """
+    Write YOLO labels for every VOC xml file in images_dir, and list the corresponding
+    images in list_file. Labels that are newer than both their xml file and the classes
+    file are left alone.
+    """
+    if not os.path.isfile(classes_file):
+        raise Exit(f"classes file {classes_file} is not a file")
+    if not os.path.isdir(images_dir):
+        raise Exit(f"{images_dir} is not a directory")
+    class_ids = {name: i for i, name in enumerate(read_class_names(classes_file))}
+    print(f"{len(class_ids)} classes")
+
+    classes_mtime = os.path.getmtime(classes_file)
+
+    xml_paths = sorted(glob(os.path.join(images_dir, "*.xml")))
+    converted = 0
+    for was_converted in tqdm(
+        map_unordered(
+            _convert_voc_annotation,
+            ((p, class_ids, classes_mtime) for p in xml_paths),
+            jobs,
+            chunk_size=64,
+        ),
+        total=len(xml_paths),
+    ):
+        converted += was_converted
+
+    with open(list_file, "w") as f:
+        f.writelines(os.path.splitext(p)[0] + ".jpg\n" for p in xml_paths)
+
+    print(f"converted {converted} annotations; {len(xml_paths) - converted} up to date")
 
 
 @task
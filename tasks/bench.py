@@ -0,0 +1,286 @@
+from invoke import task, Exit
+from typing import Callable, Optional
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+import statistics
+import numpy as np
+import cv2
+import imgaug as ia
+from card_generator.extract_card import (
+    extract_card_from_image,
+    ImageExtractionParameters,
+)
+from card_generator.find_convex_hull import find, find_all, get_find_parameters
+from card_generator.hull_manifest import HullManifest, HullManifestEntry
+from card_generator.decks.base import Deck, CardGroup
+from card_generator.scenes.fanned import FannedSceneGenerator
+from card_generator.scenes.image_source import (
+    BackgroundImageSource,
+    CardImageSource,
+    PACKED_CACHE_FILENAME,
+    PACKED_INDEX_FILENAME,
+)
+from card_generator.scenes.transforms import translate, rotate, scale
+from card_generator.types import Image
+from .util import get_deck_by_name
+
+# frame sizes for extraction, and square scene sizes and card counts for generation
+FRAME_SIZES = ((1280, 720), (1920, 1080), (3840, 2160))
+SCENE_SIZES = (1000, 2000)
+SCENE_CARD_COUNTS = (1, 3, 8)
+N_FIXTURE_CARDS = 8
+N_FIXTURE_IMAGES_PER_CARD = 2
+N_FIXTURE_BACKGROUNDS = 16
+
+
+def _draw_card(deck: Deck, group: CardGroup, rng: np.random.Generator) -> Image:
+    """
+    A BGRA card of a random light colour, with a dark block in each identifiable rect that
+    is sized to fall in the middle of that rect's hull area range.
+    """
+    card = np.full((deck.height, deck.width, 4), 255, dtype=np.uint8)
+    card[:, :, :3] = rng.integers(170, 255, 3)
+    cv2.rectangle(card, (0, 0), (deck.width - 1, deck.height - 1), (0, 0, 0, 255), 4)
+    for parameters in get_find_parameters(group, deck.width, deck.height):
+        (x1, y1), (x2, y2) = parameters.rect[0], parameters.rect[2]
+        area = sum(parameters.hull_area_range) / 2
+        shrink = np.sqrt(area / ((x2 - x1) * (y2 - y1)))
+        # the edges found around the block make its hull a pixel or so bigger all round
+        half_width = (x2 - x1) * shrink / 2 - 1
+        half_height = (y2 - y1) * shrink / 2 - 1
+        cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+        cv2.rectangle(
+            card,
+            (int(cx - half_width), int(cy - half_height)),
+            (int(cx + half_width), int(cy + half_height)),
+            (30, 30, 30, 255),
+            -1,
+        )
+    return card
+
+
+def _draw_frame(
+    card: Image, width: int, height: int, rng: np.random.Generator
+) -> Image:
+    """
+    A BGR video frame of the card lying slightly askew on a dark, textured table.
+    """
+    # unblurred noise, so that the frame is sharp enough to get past the focus checks
+    frame = rng.integers(20, 60, (height, width, 3), dtype=np.uint8)
+    card_height, card_width = card.shape[:2]
+    factor = 0.6 * height / card_height
+    # centred on the frame and turned 3 degrees anticlockwise
+    transform = (
+        translate(width / 2, height / 2)
+        @ rotate(-3)
+        @ scale(factor)
+        @ translate(-card_width / 2, -card_height / 2)
+    )
+    warped = cv2.warpAffine(card, transform[:2], (width, height))
+    mask = warped[:, :, 3] > 0
+    frame[mask] = warped[:, :, :3][mask]
+    return frame
+
+
+def _write_fixtures(directory: str, deck: Deck, rng: np.random.Generator) -> Image:
+    """
+    Write card images with a hull manifest and background images, and return a card.
+    """
+    card_names = sorted(n for g in deck.cards for n in g.card_names)[:N_FIXTURE_CARDS]
+    manifest = HullManifest(parameters={"bench": "bench"})
+    for name in card_names:
+        group = next(g for g in deck.cards if name in g.card_names)
+        os.makedirs(os.path.join(directory, "cards", name))
+        for i in range(N_FIXTURE_IMAGES_PER_CARD):
+            card = _draw_card(deck, group, rng)
+            result = find_all(card, group)
+            if not result.all_found:
+                raise Exit(f"fixture card for {name} has no hulls: {result.rejections}")
+            image_path = os.path.join(name, f"{i}.png")
+            cv2.imwrite(os.path.join(directory, "cards", image_path), card)
+            manifest.entries[image_path] = HullManifestEntry(
+                card_name=name,
+                image_path=image_path,
+                image_mtime=0,
+                fingerprint="bench",
+                # all found, so none of these are None
+                hulls=[h for h in result.hulls if h is not None],
+            )
+    manifest.save(os.path.join(directory, "cards"))
+
+    os.makedirs(os.path.join(directory, "backgrounds", "noise"))
+    for i in range(N_FIXTURE_BACKGROUNDS):
+        height, width = rng.integers(300, 640, 2)
+        background = cv2.GaussianBlur(
+            rng.integers(0, 255, (height, width, 3), dtype=np.uint8), (9, 9), 0
+        )
+        cv2.imwrite(
+            os.path.join(directory, "backgrounds", "noise", f"{i}.jpg"), background
+        )
+
+    return card
+
+
+def _time(fn: Callable[[], object], repeat: int) -> dict:
+    # one untimed call first, so that lazy imports and caches don't skew the first sample
+    fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {
+        "median_s": statistics.median(samples),
+        "min_s": min(samples),
+        "repeat": repeat,
+    }
+
+
+def _seeded(fn: Callable[[], object]) -> Callable[[], object]:
+    def seeded_fn():
+        random.seed(0)
+        ia.seed(0)
+        return fn()
+
+    return seeded_fn
+
+
+def _run_cases(directory: str, deck: Deck, repeat: int) -> dict[str, dict]:
+    rng = np.random.default_rng(0)
+    card = _write_fixtures(directory, deck, rng)
+    cards_dir = os.path.join(directory, "cards")
+    backgrounds_dir = os.path.join(directory, "backgrounds")
+    cases = {}
+
+    extraction_parameters = ImageExtractionParameters(
+        card_width=deck.width, card_height=deck.height
+    )
+    for width, height in FRAME_SIZES:
+        frame = _draw_frame(card, width, height, rng)
+        # time the whole pipeline rather than an early rejection
+        _, debug_output = extract_card_from_image(frame, extraction_parameters)
+        if debug_output.rejected_by is not None:
+            raise Exit(
+                f"fixture frame at {width}x{height} was rejected by "
+                f"{debug_output.rejected_by}"
+            )
+        cases[f"extract_card_from_image[{width}x{height}]"] = _time(
+            lambda: extract_card_from_image(frame, extraction_parameters), repeat
+        )
+
+    group = next(g for g in deck.cards if len(g.identifiable_rects) > 0)
+    for i, parameters in enumerate(get_find_parameters(group, deck.width, deck.height)):
+        cases[f"find_convex_hull.find[rect{i}]"] = _time(
+            lambda: find(card, parameters), repeat
+        )
+
+    def load_backgrounds_cold():
+        for filename in (PACKED_CACHE_FILENAME, PACKED_INDEX_FILENAME):
+            if os.path.exists(os.path.join(backgrounds_dir, filename)):
+                os.remove(os.path.join(backgrounds_dir, filename))
+        return BackgroundImageSource.from_disk(backgrounds_dir)
+
+    cases["BackgroundImageSource.from_disk[cold]"] = _time(
+        load_backgrounds_cold, repeat
+    )
+    cases["BackgroundImageSource.from_disk[cached]"] = _time(
+        lambda: BackgroundImageSource.from_disk(backgrounds_dir), repeat
+    )
+
+    CardImageSource.remove_atlas(cards_dir)
+    cases["CardImageSource.from_disk[files]"] = _time(
+        lambda: CardImageSource.from_disk(cards_dir), repeat
+    )
+    cases["CardImageSource.from_disk[lazy]"] = _time(
+        lambda: CardImageSource.from_disk(cards_dir, cache_bytes=2**20), repeat
+    )
+    CardImageSource.write_atlas(cards_dir, deck)
+    cases["CardImageSource.from_disk[atlas]"] = _time(
+        lambda: CardImageSource.from_disk(cards_dir), repeat
+    )
+
+    cards = CardImageSource.from_disk(cards_dir)
+    for size in SCENE_SIZES:
+        backgrounds = BackgroundImageSource.from_disk(backgrounds_dir, min_size=size)
+        generator = FannedSceneGenerator(
+            width=size, height=size, deck=deck, backgrounds=backgrounds, cards=cards
+        )
+        for n in SCENE_CARD_COUNTS:
+            cases[f"generate_scene[{n}cards@{size}x{size}]"] = _time(
+                _seeded(lambda: generator.generate_scene(n)), repeat
+            )
+
+    return cases
+
+
+def _compare(results: dict, baseline: dict, max_regression: float) -> list[str]:
+    regressions = []
+    for name, case in sorted(results["cases"].items()):
+        baseline_case = baseline["cases"].get(name)
+        if baseline_case is None:
+            print(f"{name}: {case['median_s'] * 1000:.2f}ms (new)")
+            continue
+        ratio = case["median_s"] / baseline_case["median_s"]
+        regressed = ratio > 1 + max_regression
+        print(
+            f"{name}: {case['median_s'] * 1000:.2f}ms vs "
+            f"{baseline_case['median_s'] * 1000:.2f}ms ({ratio:.2f}x)"
+            + (" REGRESSED" if regressed else "")
+        )
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+@task
+def run(
+    c,
+    deck_module_name="tarot",
+    output="bench.json",
+    baseline: Optional[str] = None,
+    max_regression=0.25,
+    repeat=5,
+    update_baseline=False,
+):
+    """
+    Time the hot paths against synthetic fixtures and write the results to output. With
+    --baseline, fail if any case's median is more than max_regression slower than it was
+    there; with --update-baseline, overwrite the baseline with these results instead.
+    """
+    deck = get_deck_by_name(deck_module_name)
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.devnull, "w") as devnull:
+            # the image sources report what they load, which would drown out the results
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                cases = _run_cases(directory, deck, int(repeat))
+            finally:
+                sys.stdout = stdout
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "cases": cases,
+    }
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if baseline and update_baseline:
+        with open(baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"updated baseline {baseline}")
+    elif baseline:
+        with open(baseline) as f:
+            regressions = _compare(results, json.load(f), float(max_regression))
+        if regressions:
+            raise Exit(f"{len(regressions)} cases regressed: {', '.join(regressions)}")
+    else:
+        for name, case in sorted(cases.items()):
+            print(f"{name}: {case['median_s'] * 1000:.2f}ms")
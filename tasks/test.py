@@ -6,11 +6,15 @@ import shutil
 import numpy as np
 from glob import glob
 import random
+import itertools
+import dataclasses
 from card_generator.extract_card import (
     extract_card_from_image,
-    extract_cards_from_video,
+    iter_cards_from_video,
     ImageExtractionParameters,
     VideoExtractionParameters,
+    REJECTED_BY_PREFILTER_FOCUS,
+    REJECTED_BY_PREFILTER_SHAPE,
 )
 from card_generator.find_convex_hull import (
     find as find_convex_hull_impl,
@@ -18,7 +22,7 @@ from card_generator.find_convex_hull import (
 )
 from card_generator.scenes.fanned import FannedSceneGenerator
 from card_generator.decks.base import Deck, CardGroup
-from card_generator.util import show_images_in_windows
+from card_generator.util import show_images_in_windows, AsyncImageWriter
 from card_generator.scenes.image_source import BackgroundImageSource, CardImageSource
 from .util import get_deck_by_name
 
@@ -47,9 +51,12 @@ def extract_image(c, deck_module_name, infile):
     result, debug_output = extract_card_from_image(
         cv2.imread(infile),
         ImageExtractionParameters(card_width=deck.width, card_height=deck.height),
+        debug=True,
     )
 
+    print("prefilter focus:", debug_output.prefilter_focus)
     print("focus:", debug_output.focus)
+    print("rejected by:", debug_output.rejected_by)
     show_images_in_windows(
         ("Grayscale", debug_output.grayscale),
         ("Edged", debug_output.edged),
@@ -63,18 +70,90 @@ def extract_image(c, deck_module_name, infile):
 def extract_video(c, deck_module_name, infile, outdir="example/output/frames/"):
     deck = get_deck_by_name(deck_module_name)
 
-    result = extract_cards_from_video(
-        cv2.VideoCapture(infile),
-        VideoExtractionParameters(card_width=deck.width, card_height=deck.height),
-    )
-
     shutil.rmtree(outdir, ignore_errors=True)
     os.makedirs(outdir, exist_ok=True)
 
-    for i, image in enumerate(result):
-        cv2.imwrite(os.path.join(outdir, f"{i}.png"), image)
+    n = 0
+    with AsyncImageWriter() as writer:
+        for image in iter_cards_from_video(
+            cv2.VideoCapture(infile),
+            VideoExtractionParameters(card_width=deck.width, card_height=deck.height),
+        ):
+            writer.write(os.path.join(outdir, f"{n}.png"), image)
+            n += 1
 
-    print(f"success; extracted {len(result)} images to {outdir}")
+    print(f"success; extracted {n} images to {outdir}")
+
+
+@task
+def check_prefilter(c, deck_module_name, infile):
+    """
+    The prefilter must only reject frames that the full-resolution pipeline would reject
+    anyway: run every frame of a video through extraction with and without it, and fail
+    if it rejects any frame that's extracted without it.
+    """
+    deck = get_deck_by_name(deck_module_name)
+    parameters = ImageExtractionParameters(
+        card_width=deck.width, card_height=deck.height
+    )
+    unfiltered_parameters = dataclasses.replace(parameters, prefilter=False)
+
+    video = cv2.VideoCapture(infile)
+    n_frames = 0
+    n_prefiltered = 0
+    wrongly_rejected = []
+    while True:
+        success, frame = video.read()
+        if not success:
+            break
+        _, debug_output = extract_card_from_image(frame, parameters)
+        if debug_output.rejected_by in (
+            REJECTED_BY_PREFILTER_FOCUS,
+            REJECTED_BY_PREFILTER_SHAPE,
+        ):
+            n_prefiltered += 1
+            result, _ = extract_card_from_image(frame, unfiltered_parameters)
+            if result is not None:
+                wrongly_rejected.append(f"{n_frames} ({debug_output.rejected_by})")
+        n_frames += 1
+
+    if wrongly_rejected:
+        raise Exit(
+            f"the prefilter rejected {len(wrongly_rejected)} frames that would have "
+            f"been extracted: {', '.join(wrongly_rejected)}"
+        )
+    print(
+        f"success; the prefilter rejected {n_prefiltered} of {n_frames} frames, none of "
+        "which would have been extracted"
+    )
+
+
+@task
+def check_tracking(c, deck_module_name, infile):
+    """
+    Tracking the card between frames must only save work: fail unless extracting every
+    frame of a video with and without it gives identical cards.
+    """
+    deck = get_deck_by_name(deck_module_name)
+    parameters = VideoExtractionParameters(
+        card_width=deck.width, card_height=deck.height, skip_frames=1
+    )
+
+    tracked = iter_cards_from_video(
+        cv2.VideoCapture(infile), parameters, show_progress=False
+    )
+    untracked = iter_cards_from_video(
+        cv2.VideoCapture(infile),
+        dataclasses.replace(parameters, track_card=False),
+        show_progress=False,
+    )
+    # compare as they come, rather than holding every card of both runs at once
+    n = 0
+    for a, b in itertools.zip_longest(tracked, untracked):
+        if a is None or b is None or not np.array_equal(a, b):
+            raise Exit(f"card {n} differs between tracked and untracked extraction")
+        n += 1
+    print(f"success; extracted the same {n} cards with and without tracking")
 
 
 @task
@@ -119,6 +198,7 @@ def show_hulls(c, deck_module_name, file=None, directory="data/cards", n=1):
                         rect=r.as_nparray(deck.width, deck.height),
                         hull_area_range=r.hull_area_range,
                     ),
+                    debug=True,
                 )
                 print(debug_output.hull_size)
                 images.append((f"{path} - Grayscale ({i})", debug_output.grayscale))
@@ -167,11 +247,12 @@ def random_background(c, directory="data/backgrounds"):
 @task
 def random_card(c, directory="data/cards"):
     s = CardImageSource.from_disk(directory)
-    name, image, hulls = s.get_random_cards(1)[0]
-    image = cv2.cvtColor(image, cv2.COLOR_RGBA2BGRA)
-    for h in hulls:
+    card = s.get_random_cards(1)[0]
+    # the atlas is mapped read-only
+    image = card.image.copy()
+    for h in card.hulls:
         cv2.drawContours(image, [h], 0, (0, 255, 0), 1)
-    show_images_in_windows((name, image))
+    show_images_in_windows((card.name, image))
 
 
 @task
@@ -189,7 +270,6 @@ def generate_fanned_hand(
         cards=cards,
     )
     image, bounding_boxes = generator.generate_scene(n)
-    image = cv2.cvtColor(image, cv2.COLOR_RGBA2BGRA)
     for b in bounding_boxes:
         cv2.drawContours(
             image,
@@ -1,6 +1,15 @@
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
 from invoke import task, Collection, Task
+from contextlib import contextmanager
 from card_generator.decks.base import Deck
+from card_generator import metrics
 import importlib
+import multiprocessing
+import json
+import os
+
+T = TypeVar("T")
+R = TypeVar("R")
 
 
 def augment_with_task_decorator(collection: Collection):
@@ -16,3 +25,43 @@ def augment_with_task_decorator(collection: Collection):
 
 def get_deck_by_name(deck_module_name: str) -> Deck:
     return importlib.import_module(f"card_generator.decks.{deck_module_name}").DECK
+
+
+def map_unordered(
+    fn: Callable[[T], R], items: Iterable[T], jobs: int, chunk_size: int = 1
+) -> Iterator[R]:
+    """
+    Map fn over items across jobs processes (0 means one per core), yielding results as
+    they complete. jobs=1 runs in this process instead, which keeps tracebacks and progress
+    bars readable. Raise chunk_size when each item is too quick to be worth a round trip.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        yield from map(fn, items)
+    else:
+        with multiprocessing.Pool(jobs) as pool:
+            yield from metrics.imap(pool, fn, items, chunk_size)
+
+
+@contextmanager
+def metrics_output(path: Optional[str]):
+    """
+    Enable metrics for the duration of a task if path is given, and write them there when
+    it exits: as Prometheus text if path ends in .prom, otherwise as JSON.
+    """
+    if not path:
+        yield
+        return
+
+    metrics.enable()
+    try:
+        yield
+    finally:
+        metrics.record_peak_rss()
+        measurements = metrics.snapshot()
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(metrics.to_prometheus(measurements))
+            else:
+                json.dump(measurements, f, indent=2)
+        print(f"wrote metrics to {path}")